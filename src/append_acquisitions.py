@@ -0,0 +1,45 @@
+import argparse
+import os
+import pandas as pd
+
+from datasets import parcelio
+from datasets.ParcelStore import ParcelStore
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="appends new acquisitions to the cached parcels of a region without "
+                                                 "rebuilding the cache. e.g. python append_acquisitions.py "
+                                                 "acquisitions.csv --root /data/BavarianCrops --region holl")
+    parser.add_argument(
+        'acquisitions', type=str, help='csv file with the columns id, doa and the bands B1 ... B9 of the new acquisitions')
+    parser.add_argument(
+        '--root', type=str, default="/data/BavarianCrops", help='root of the dataset')
+    parser.add_argument(
+        '--region', type=str, default=None, help='BavarianCrops region. Without region the VNRice cache is used')
+    parser.add_argument('--compact', action='store_true', help="append to the compact uint16 cache")
+    parser.add_argument('--consolidate', action='store_true',
+                        help="fold all delta segments into the cached arrays afterwards")
+    args, _ = parser.parse_known_args()
+    return args
+
+if __name__=="__main__":
+
+    args = parse_args()
+
+    cache = os.path.join(args.root, "npy", "parcels.{}".format(ParcelStore.cache_key(args.compact)))
+    data_folder = os.path.join(args.root, "csv")
+    if args.region is not None:
+        cache = os.path.join(cache, args.region)
+        data_folder = os.path.join(data_folder, args.region)
+
+    store = ParcelStore(cache, data_folder, compact=args.compact)
+    assert store.exists(), "no cached parcels in {}. Build them by loading the dataset once".format(cache)
+    store.load()
+
+    acquisitions = pd.read_csv(args.acquisitions, usecols=["id", parcelio.DATE_COLUMN] + parcelio.BANDS)
+    n = store.append(acquisitions["id"].values, pd.to_datetime(acquisitions[parcelio.DATE_COLUMN]).values,
+                     acquisitions[parcelio.BANDS].values)
+    print("appended {} acquisitions of {} parcels to {}".format(n, acquisitions["id"].nunique(), cache))
+
+    if args.consolidate:
+        store.consolidate()
+        print("consolidated {}".format(cache))
@@ -0,0 +1,228 @@
+import sys
+sys.path.append("./models")
+
+import argparse
+import os
+import tempfile
+import time
+import datetime
+import numpy as np
+import pandas as pd
+import torch
+from numpy import genfromtxt
+
+from datasets import parcelio
+from datasets import GAFDataset as gaf
+from datasets.BavarianCrops_Dataset import BavarianCropsDataset
+from datasets.ConcatDataset import ConcatDataset
+from datasets.batching import batch_dataloader
+from datasets.ResidentLoader import ResidentLoader
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="micro benchmarks of the data pipeline on synthetic data")
+    parser.add_argument(
+        'benchmark', type=str, choices=["csv", "gaf", "batch", "compact"], help='benchmark to run')
+    parser.add_argument(
+        '-n', '--nsamples', type=int, default=2000, help='number of synthetic parcels')
+    parser.add_argument(
+        '-t', '--sequencelength', type=int, default=140, help='number of acquisitions per synthetic parcel')
+    parser.add_argument(
+        '-b', '--batchsize', type=int, default=256, help='batch size')
+    parser.add_argument(
+        '--samplet', type=int, default=70, help='number of sampled acquisitions per parcel')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='random seed of the synthetic data')
+    args, _ = parser.parse_known_args()
+    return args
+
+def write_synthetic_parcels(folder, nsamples=2000, sequencelength=140, nanfraction=0.03, seed=0):
+    """writes <folder>/<id>.csv files in the BavarianCrops csv layout and returns the list of ids"""
+    random = np.random.RandomState(seed)
+    header = "," + ",".join(parcelio.BANDS + ['QA10', 'QA20', 'QA60', 'doa', 'label', 'id'])
+    start = datetime.date(2018, 1, 1)
+
+    ids = list(range(nsamples))
+    for id in ids:
+        nutzcode = random.choice([411, 451, 171, 311])
+        lines = [header]
+        for t in range(sequencelength):
+            bands = [str(v) for v in random.randint(0, 10000, size=len(parcelio.BANDS))]
+            if random.rand() < nanfraction:
+                bands[random.randint(len(bands))] = ""
+            doa = (start + datetime.timedelta(days=2 * t)).isoformat()
+            lines.append(",".join([str(t)] + bands + ["0", "0", "0", doa, str(nutzcode), str(id)]))
+
+        with open(os.path.join(folder, "{}.csv".format(id)), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    return ids
+
+def genfromtxt_load(csv_file):
+    """the former parser of BavarianCropsDataset.load"""
+    data = genfromtxt(csv_file, delimiter=',', skip_header=1)
+    X = data[:, 1:14] * parcelio.NORMALIZING_FACTOR
+    nutzcodes = data[:, 18]
+    t_without_nans = np.isnan(X).sum(1) > 0
+    return X[~t_without_nans], nutzcodes[~t_without_nans]
+
+def write_synthetic_bavariancrops(folder, region="holl", nsamples=2000, sequencelength=140, seed=0):
+    """writes csv/<region>/<id>.csv, block id files and classmapping.csv in the BavarianCropsDataset layout"""
+    os.makedirs(os.path.join(folder, "csv", region))
+    ids = write_synthetic_parcels(os.path.join(folder, "csv", region), nsamples=nsamples, sequencelength=sequencelength, seed=seed)
+
+    os.makedirs(os.path.join(folder, "ids", "blocks"))
+    for partition, partition_ids in [("train", ids[:nsamples // 2]), ("valid", ids[nsamples // 2:nsamples * 3 // 4]),
+                                     ("test", ids[nsamples * 3 // 4:])]:
+        np.savetxt(os.path.join(folder, "ids", "blocks", "{}_{}.txt".format(region, partition)), partition_ids, fmt="%d")
+
+    classmapping = os.path.join(folder, "classmapping.csv")
+    with open(classmapping, "w") as f:
+        f.write(",nutzcode,id,classname,klassenname\n")
+        for i, nutzcode in enumerate([451, 411, 171, 311]):
+            f.write("{},{},{},class{},klasse{}\n".format(i, nutzcode, i // 2, i // 2, i // 2))
+
+    return classmapping
+
+def write_synthetic_gaf(folder, region="holl", nsamples=2000, sequencelength=140, seed=0):
+    """writes test_train_<region>.h5, block and random id files and classmapping.csv in the GAFDataset layout"""
+    random = np.random.RandomState(seed)
+    start = datetime.date(2018, 1, 1)
+    dates = [(start + datetime.timedelta(days=2 * t)).isoformat() for t in range(sequencelength)]
+
+    columns = dict()
+    for band in gaf.BANDS:
+        for date in dates:
+            columns["s2/{}_{}_median".format(band, date)] = random.randint(0, 10000, size=nsamples).astype(float)
+    data = pd.DataFrame(columns)
+    ids = np.arange(nsamples)
+    data["CRPGRPSTM"] = random.choice([1, 2, 3, 4], size=nsamples)
+    data["STMNAME"] = ["parcel {}".format(id) for id in ids]
+    data["ID"] = ids
+    data["coordx_lon"] = random.rand(nsamples)
+    data["coordy_lat"] = random.rand(nsamples)
+
+    with pd.HDFStore(os.path.join(folder, "test_train_{}.h5".format(region)), "w") as hdf:
+        hdf["train_data"] = data.iloc[:nsamples // 2]
+        hdf["test_data"] = data.iloc[nsamples // 2:]
+
+    for scheme in ["random", "blocks"]:
+        os.makedirs(os.path.join(folder, "ids", scheme))
+        for partition, partition_ids in [("train", ids[:nsamples // 2]), ("test", ids[nsamples // 2:])]:
+            np.savetxt(os.path.join(folder, "ids", scheme, "{}_{}.txt".format(region, partition)), partition_ids, fmt="%d")
+
+    classmapping = os.path.join(folder, "classmapping.csv")
+    with open(classmapping, "w") as f:
+        f.write(",nutzcode,id,classname,klassenname,gafcode\n")
+        for i, (nutzcode, gafcode) in enumerate([(451, 1), (411, 2), (171, 3), (311, 4)]):
+            f.write("{},{},{},class{},klasse{},{}\n".format(i, nutzcode, i // 2, i // 2, i // 2, gafcode))
+
+    return classmapping
+
+def gaf_getitem(dataset, idx):
+    """the former GAFDataset.__getitem__ with a lookup in the mapping table per item"""
+    X = np.ascontiguousarray(dataset.features[:, dataset.index[idx]].T)
+    y = dataset.y[idx]
+    y = dataset.mapping.loc[dataset.mapping.gafcode == y].id.iloc[0]
+    y = np.repeat(y, dataset.sequencelength)
+    X = torch.from_numpy(X).type(torch.FloatTensor)
+    y = torch.from_numpy(y).type(torch.LongTensor)
+    return X, y, int(dataset.meta[idx][2])
+
+def timeit(fun, files):
+    start = time.time()
+    for f in files:
+        fun(f)
+    return time.time() - start
+
+def benchmark_csv(args):
+    with tempfile.TemporaryDirectory() as folder:
+        print("writing {} synthetic parcels with {} acquisitions to {}".format(args.nsamples, args.sequencelength, folder))
+        ids = write_synthetic_parcels(folder, nsamples=args.nsamples, sequencelength=args.sequencelength, seed=args.seed)
+        files = [os.path.join(folder, "{}.csv".format(id)) for id in ids]
+
+        # check that all parsers agree before timing them
+        for f in files[:10]:
+            X, nutzcodes = genfromtxt_load(f)
+            for engine in ["numpy", "pandas"]:
+                X_, nutzcodes_ = parcelio.read_parcel_csv(f, engine=engine)
+                assert np.array_equal(X.astype(np.float32), X_) and np.array_equal(nutzcodes, nutzcodes_)
+
+        reference = timeit(genfromtxt_load, files)
+        print("{:<28} {:8.2f} files/s".format("genfromtxt", len(files) / reference))
+        for engine in ["numpy", "pandas"]:
+            duration = timeit(lambda f: parcelio.read_parcel_csv(f, engine=engine), files)
+            print("{:<28} {:8.2f} files/s ({:.1f}x)".format("read_parcel_csv "+engine, len(files) / duration, reference / duration))
+
+def benchmark_gaf(args):
+    with tempfile.TemporaryDirectory() as folder:
+        print("writing {} synthetic gaf parcels with {} acquisitions to {}".format(args.nsamples, args.sequencelength, folder))
+        classmapping = write_synthetic_gaf(folder, nsamples=args.nsamples, sequencelength=args.sequencelength, seed=args.seed)
+        dataset = gaf.GAFDataset(folder, "holl", "train", classmapping, scheme="random")
+        items = list(range(len(dataset)))
+
+        for idx in items[:10]:
+            X, y, id = gaf_getitem(dataset, idx)
+            X_, y_, id_ = dataset[idx]
+            assert torch.equal(X, X_) and torch.equal(y, y_) and id == id_
+
+        reference = timeit(lambda idx: gaf_getitem(dataset, idx), items)
+        print("{:<28} {:8.2f} items/s".format("mapping lookup per item", len(items) / reference))
+        duration = timeit(lambda idx: dataset[idx], items)
+        print("{:<28} {:8.2f} items/s ({:.1f}x)".format("GAFDataset.__getitem__", len(items) / duration, reference / duration))
+
+def benchmark_batch(args):
+    with tempfile.TemporaryDirectory() as folder:
+        print("writing {} synthetic parcels with {} acquisitions to {}".format(args.nsamples, args.sequencelength, folder))
+        classmapping = write_synthetic_bavariancrops(folder, nsamples=args.nsamples, sequencelength=args.sequencelength, seed=args.seed)
+        # train and valid partitions concatenated like the regions in train.py
+        dataset = ConcatDataset([BavarianCropsDataset(folder, partition, classmapping, scheme="blocks", region="holl",
+                                                      samplet=args.samplet) for partition in ["train", "valid"]])
+
+        loaders = [
+            ("__getitem__ + collate", torch.utils.data.DataLoader(dataset, batch_size=args.batchsize, shuffle=True)),
+            ("batch_dataloader", batch_dataloader(dataset, args.batchsize, shuffle=True)),
+            ("ResidentLoader", ResidentLoader(dataset, args.batchsize, shuffle=True))
+        ]
+
+        reference = None
+        for name, loader in loaders:
+            start = time.time()
+            for X, y, ids in loader:
+                assert X.shape == (len(ids), args.samplet, dataset.ndims) and y.shape == X.shape[:2]
+            duration = time.time() - start
+            reference = duration if reference is None else reference
+            print("{:<28} {:8.2f} samples/s ({:.1f}x)".format(name, len(dataset) / duration, reference / duration))
+
+def benchmark_compact(args):
+    with tempfile.TemporaryDirectory() as folder:
+        print("writing {} synthetic parcels with {} acquisitions to {}".format(args.nsamples, args.sequencelength, folder))
+        classmapping = write_synthetic_bavariancrops(folder, nsamples=args.nsamples, sequencelength=args.sequencelength, seed=args.seed)
+
+        for compact in [False, True]:
+            # first construction parses the csv files, the second one loads the cache into memory
+            BavarianCropsDataset(folder, "train", classmapping, scheme="blocks", region="holl", samplet=args.samplet,
+                                 compact=compact)
+            start = time.time()
+            dataset = BavarianCropsDataset(folder, "train", classmapping, scheme="blocks", region="holl",
+                                           samplet=args.samplet, mmap=False, compact=compact)
+            loading = time.time() - start
+
+            start = time.time()
+            for X, y, ids in batch_dataloader(dataset, args.batchsize, shuffle=True):
+                pass
+            duration = time.time() - start
+
+            print("{:<8} values {:8.2f} MB, loading {:6.3f}s, batch_dataloader {:8.2f} samples/s".format(
+                str(dataset.X.values.dtype), dataset.X.values.nbytes / 1e6, loading, len(dataset) / duration))
+
+if __name__=="__main__":
+
+    args = parse_args()
+    if args.benchmark == "csv":
+        benchmark_csv(args)
+    elif args.benchmark == "gaf":
+        benchmark_gaf(args)
+    elif args.benchmark == "batch":
+        benchmark_batch(args)
+    elif args.benchmark == "compact":
+        benchmark_compact(args)
@@ -0,0 +1,33 @@
+import argparse
+import os
+
+from datasets.RegionFile import RegionFile
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="converts the per parcel csv files of a region into one hdf5 region "
+                                                 "file, which BavarianCropsDataset and VNRiceDataset read instead of "
+                                                 "the csv files. e.g. python convert_parcels.py "
+                                                 "--root /data/BavarianCrops --regions holl krum nowa")
+    parser.add_argument(
+        '--root', type=str, default="/data/BavarianCrops", help='root of the dataset')
+    parser.add_argument(
+        '--regions', type=str, nargs='+', default=None,
+        help='BavarianCrops regions. csv/<region> is written to h5/<region>.h5. '
+             'Without regions csv is written to h5/parcels.h5 (VNRice)')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=4, help='number of processes parsing csv files')
+    parser.add_argument(
+        '--chunksize', type=int, default=1000, help='number of parcels appended to the region file at once')
+    args, _ = parser.parse_known_args()
+    return args
+
+if __name__=="__main__":
+
+    args = parse_args()
+    if args.regions is None:
+        RegionFile.convert(os.path.join(args.root, "csv"), os.path.join(args.root, "h5", "parcels.h5"),
+                           workers=args.workers, chunksize=args.chunksize)
+    else:
+        for region in args.regions:
+            RegionFile.convert(os.path.join(args.root, "csv", region), os.path.join(args.root, "h5", region + ".h5"),
+                               workers=args.workers, chunksize=args.chunksize)
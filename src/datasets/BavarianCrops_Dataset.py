@@ -3,8 +3,11 @@ import torch.utils.data
 import pandas as pd
 import os
 import numpy as np
-from numpy import genfromtxt
-import tqdm
+from datasets import parcelio
+from datasets.ParcelStore import ParcelStore
+from datasets.RegionFile import RegionFile
+from datasets.ClassLookup import ClassLookup
+from datasets.batching import is_batch, sample_times
 
 
 BANDS = ['B1', 'B10', 'B11', 'B12', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8',
@@ -14,13 +17,18 @@ PADDING_VALUE = -1
 
 class BavarianCropsDataset(torch.utils.data.Dataset):
 
-    def __init__(self, root, partition, classmapping, mode=None, scheme="random", region=None, samplet=70, cache=True, seed=0, validfraction=0.1):
+    def __init__(self, root, partition, classmapping, mode=None, scheme="random", region=None, samplet=70, cache=True, seed=0, validfraction=0.1, workers=1, mmap=True, refresh=False, compact=False, grid=None):
         assert (mode in ["trainvalid", "traintest"] and scheme=="random") or (mode is None and scheme=="blocks") # <- if scheme random mode is required, else None
         assert scheme in ["random","blocks"]
         assert partition in ["train","test","trainvalid","valid"]
 
         self.seed = seed
         self.validfraction = validfraction
+        self.workers = workers # number of processes parsing csv files into the store
+        self.mmap = mmap # serve X from the memory-mapped cache shared by all processes
+        self.compact = compact # store uint16 digital numbers and scale them to reflectances in __getitem__
+        self.grid = grid # dates all parcels are resampled onto (see resampling.date_grid) or None for the acquisitions
+        assert grid is None or samplet is None, "parcels resampled onto a grid have the same times and are not sampled"
         self.scheme = scheme
 
         # ensure that different seeds are set per partition
@@ -49,6 +57,7 @@ class BavarianCropsDataset(torch.utils.data.Dataset):
 
         self.mapping = pd.read_csv(classmapping, index_col=0).sort_values(by="id")
         self.mapping = self.mapping.set_index("nutzcode")
+        self.lookup = ClassLookup(self.mapping.index.values, self.mapping["id"].values)
         self.classes = self.mapping["id"].unique()
         self.classname = self.mapping.groupby("id").first().classname.values
         self.klassenname = self.mapping.groupby("id").first().klassenname.values
@@ -58,24 +67,35 @@ class BavarianCropsDataset(torch.utils.data.Dataset):
         self.partition = partition
         self.data_folder = "{root}/csv/{region}".format(root=self.root, region=self.region)
         self.samplet = samplet
+        # samplet=None pads items to the longest sequence of the dataset. pad_collate batches set it to False
+        self.pad_items = True
 
         #all_csv_files
         #self.csvfiles = [ for f in os.listdir(root)]
         print("Initializing BavarianCropsDataset {} partition in {}".format(self.partition, self.region))
 
-        self.cache = os.path.join(self.root,"npy",os.path.basename(classmapping), scheme,region, partition)
+        # all parcels of the region are parsed once into a store that is shared by partitions, schemes and classmappings
+        self.cache = os.path.join(self.root, "npy", "parcels.{}".format(ParcelStore.cache_key(compact)), region)
+        # a region file written by convert_parcels.py replaces the csv files
+        self.region_file = RegionFile(os.path.join(self.root, "h5", region + ".h5"))
+        self.store = ParcelStore(self.cache, self.data_folder, workers=workers, mmap=mmap, compact=compact,
+                                 region_file=self.region_file if self.region_file.exists() else None)
+        source = self.region_file.path if self.region_file.exists() else str(self.data_folder)
 
         print("read {} classes".format(self.nclasses))
 
-        if cache and self.cache_exists() and not self.mapping_consistent_with_cache():
-            self.clean_cache()
-
-        if cache and self.cache_exists() and self.mapping_consistent_with_cache():
+        regionids = self.read_region_ids()
+        if cache and self.store.exists():
             print("precached dataset files found at " + self.cache)
-            self.load_cached_dataset()
+            self.store.load()
+            if refresh or not self.store.consistent(regionids):
+                print("updating cached dataset with new or changed parcels in " + source)
+                self.store.update(regionids)
         else:
-            print("no cached dataset found. iterating through csv folders in " + str(self.data_folder))
-            self.cache_dataset()
+            print("no cached dataset found. iterating through parcels in " + source)
+            self.store.update(regionids, incremental=False)
+
+        self.select_parcels()
 
         self.hist, _ = np.histogram(self.y, bins=self.nclasses)
 
@@ -158,47 +178,52 @@ class BavarianCropsDataset(torch.utils.data.Dataset):
             ids = read(self.trainids) + read(self.validids)
         return ids
 
-    def cache_dataset(self):
+    def read_region_ids(self):
+        """sorted unique ids of all id files of the region. The store holds the parcels of these ids"""
+        ids = list()
+        for scheme in ["random", "blocks"]:
+            for partition in ["train", "valid", "test"]:
+                filename = os.path.join(self.root, "ids", scheme, "{}_{}.txt".format(self.region, partition))
+                if os.path.exists(filename):
+                    with open(filename, "r") as f:
+                        ids += [int(id) for id in f.readlines()]
+        return np.unique(np.array(ids, dtype=np.int64))
+
+    def select_parcels(self):
         """
-        Iterates though the data folders and stores y, ids, classweights, and sequencelengths
-        X is loaded at with getitem
+        Selects the parcels of the partition with a nutzcode in the classmapping from the store
+        and stores y, ids, classweights, and sequencelengths. X is an index view into the values of the store
         """
-        #ids = self.split(self.partition)
-
-        ids = self.read_ids()
+        # read_ids reseeds numpy, which must not change the random state of the dataset
+        state = np.random.get_state()
+        ids = np.array(self.read_ids(), dtype=np.int64)
+        np.random.set_state(state)
         assert len(ids) > 0
 
-        self.X = list()
-        self.nutzcodes = list()
+        missing = self.store.missing(ids)
         self.stats = dict(
-            not_found=list()
+            not_found=[self.data_folder + "/{id}.csv".format(id=id) for id in ids[missing]]
         )
-        self.ids = list()
-        self.samples = list()
-        #i = 0
-        for id in tqdm.tqdm(ids):
-
-            id_file = self.data_folder+"/{id}.csv".format(id=id)
-            if os.path.exists(id_file):
-                self.samples.append(id_file)
-
-                X,nutzcode = self.load(id_file)
-
-                if len(nutzcode) > 0:
-                    nutzcode = nutzcode[0]
-                    if nutzcode in self.mapping.index:
-                        self.X.append(X)
-                        self.nutzcodes.append(nutzcode)
-                        self.ids.append(id)
-            else:
-                self.stats["not_found"].append(id_file)
+        self.samples = [self.data_folder + "/{id}.csv".format(id=id) for id in ids[~missing]]
 
+        position = self.store.index(ids)
+        position = position[position >= 0]
+        mapped = self.lookup.contains(self.store.nutzcodes[position])
+        self.index = position[mapped]
+
+        self.ids = self.store.ids[self.index]
+        self.nutzcodes = self.store.nutzcodes[self.index]
         self.y = self.applyclassmapping(self.nutzcodes)
+        if self.grid is None:
+            self.X = self.store.X.take(self.index)
+        else:
+            # float32 reflectances at the grid dates: all sequences have the same length and need no padding
+            self.X = self.store.resampled(self.grid).take(self.index)
 
-        self.sequencelengths = np.array([np.array(X).shape[0] for X in self.X])
+        self.sequencelengths = self.X.sequencelengths
         assert len(self.sequencelengths) > 0
         self.sequencelength = self.sequencelengths.max()
-        self.ndims = np.array(X).shape[1]
+        self.ndims = self.X.ndims
 
         self.hist,_ = np.histogram(self.y, bins=self.nclasses)
         self.classweights = 1 / self.hist
@@ -208,89 +233,26 @@ class BavarianCropsDataset(torch.utils.data.Dataset):
         #    raise ValueError("Class {id} (nutzcode {nutzcode}) has 0 occurences in the dataset! "
         #                     "Check dataset or mapping table".format(id=classid_, nutzcode=nutzid_))
 
-
-        #self.dataweights = np.array([self.classweights[y] for y in self.y])
-
-        self.cache_variables(self.y, self.sequencelengths, self.ids, self.ndims, self.X, self.classweights)
-
-    def mapping_consistent_with_cache(self):
-        # cached y must have the same number of classes than the mapping
-        return True
-        #return len(np.unique(np.load(os.path.join(self.cache, "y.npy")))) == self.nclasses
-
-    def cache_variables(self, y, sequencelengths, ids, ndims, X, classweights):
-        os.makedirs(self.cache, exist_ok=True)
-        # cache
-        np.save(os.path.join(self.cache, "classweights.npy"), classweights)
-        np.save(os.path.join(self.cache, "y.npy"), y)
-        np.save(os.path.join(self.cache, "ndims.npy"), ndims)
-        np.save(os.path.join(self.cache, "sequencelengths.npy"), sequencelengths)
-        np.save(os.path.join(self.cache, "ids.npy"), ids)
-        #np.save(os.path.join(self.cache, "dataweights.npy"), dataweights)
-        np.save(os.path.join(self.cache, "X.npy"), X)
-
-    def load_cached_dataset(self):
-        # load
-        self.classweights = np.load(os.path.join(self.cache, "classweights.npy"))
-        self.y = np.load(os.path.join(self.cache, "y.npy"))
-        self.ndims = int(np.load(os.path.join(self.cache, "ndims.npy")))
-        self.sequencelengths = np.load(os.path.join(self.cache, "sequencelengths.npy"))
-        self.sequencelength = self.sequencelengths.max()
-        self.ids = np.load(os.path.join(self.cache, "ids.npy"))
-        self.X = np.load(os.path.join(self.cache, "X.npy"), allow_pickle=True)
-
-    def cache_exists(self):
-        weightsexist = os.path.exists(os.path.join(self.cache, "classweights.npy"))
-        yexist = os.path.exists(os.path.join(self.cache, "y.npy"))
-        ndimsexist = os.path.exists(os.path.join(self.cache, "ndims.npy"))
-        sequencelengthsexist = os.path.exists(os.path.join(self.cache, "sequencelengths.npy"))
-        idsexist = os.path.exists(os.path.join(self.cache, "ids.npy"))
-        Xexists = os.path.exists(os.path.join(self.cache, "X.npy"))
-        return yexist and sequencelengthsexist and idsexist and ndimsexist and Xexists and weightsexist
-
-    def clean_cache(self):
-        os.remove(os.path.join(self.cache, "classweights.npy"))
-        os.remove(os.path.join(self.cache, "y.npy"))
-        os.remove(os.path.join(self.cache, "ndims.npy"))
-        os.remove(os.path.join(self.cache, "sequencelengths.npy"))
-        os.remove(os.path.join(self.cache, "ids.npy"))
-        #os.remove(os.path.join(self.cache, "dataweights.npy"))
-        os.remove(os.path.join(self.cache, "X.npy"))
-        os.removedirs(self.cache)
-
     def load(self, csv_file, load_pandas = False):
         """['B1', 'B10', 'B11', 'B12', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8',
        'B8A', 'B9', 'QA10', 'QA20', 'QA60', 'doa', 'label', 'id']"""
+        return parcelio.load(csv_file, load_pandas=load_pandas)
 
-        if load_pandas:
-            sample = pd.read_csv(csv_file, index_col=0)
-            X = np.array((sample[BANDS] * NORMALIZING_FACTOR).values)
-            nutzcodes = sample["label"].values
-            # nutzcode to classids (451,411) -> (0,1)
-
-        else: # load with numpy
-            data = genfromtxt(csv_file, delimiter=',', skip_header=1)
-            X = data[:, 1:14] * NORMALIZING_FACTOR
-            nutzcodes = data[:, 18]
-
-        # drop times that contain nans
-        if np.isnan(X).any():
-            t_without_nans = np.isnan(X).sum(1) > 0
-
-            X = X[~t_without_nans]
-            nutzcodes = nutzcodes[~t_without_nans]
-
-        return X, nutzcodes
-
-    def applyclassmapping(self, nutzcodes):
-        """uses a mapping table to replace nutzcodes (e.g. 451, 411) with class ids"""
-        return np.array([self.mapping.loc[nutzcode]["id"] for nutzcode in nutzcodes])
+    def applyclassmapping(self, nutzcodes, unknown="raise"):
+        """
+        uses a mapping table to replace nutzcodes (e.g. 451, 411) with class ids.
+        Unknown nutzcodes raise a KeyError or are replaced by unknown if it is an integer. see ClassLookup
+        """
+        return self.lookup(nutzcodes, unknown=unknown)
 
     def __len__(self):
         return len(self.ids)
 
     def __getitem__(self, idx):
 
+        if is_batch(idx):
+            return self.getbatch(idx)
+
         load_file = False
         if load_file:
             id = self.ids[idx]
@@ -300,15 +262,21 @@ class BavarianCropsDataset(torch.utils.data.Dataset):
         else:
 
             X = self.X[idx]
-            y = np.array([self.y[idx]] * X.shape[0]) # repeat y for each entry in x
+            if self.X.values.dtype == np.uint16:
+                X = parcelio.scale(X)
+            y = np.full(X.shape[0], self.y[idx]) # repeat y for each entry in x
 
         # pad up to maximum sequence length
         t = X.shape[0]
 
         if self.samplet is None:
-            npad = self.sequencelengths.max() - t
-            X = np.pad(X,[(0,npad), (0,0)],'constant', constant_values=PADDING_VALUE)
-            y = np.pad(y, (0, npad), 'constant', constant_values=PADDING_VALUE)
+            if self.pad_items:
+                npad = self.sequencelengths.max() - t
+                X = np.pad(X,[(0,npad), (0,0)],'constant', constant_values=PADDING_VALUE)
+                y = np.pad(y, (0, npad), 'constant', constant_values=PADDING_VALUE)
+            else:
+                # copy of the memory-mapped values, padded by pad_collate
+                X = np.array(X)
         else:
             idxs = np.random.choice(t, self.samplet, replace=False)
             idxs.sort()
@@ -321,6 +289,35 @@ class BavarianCropsDataset(torch.utils.data.Dataset):
 
         return X, y, self.ids[idx]
 
+    def getbatch(self, indices):
+        """
+        X [B x T x D], y [B x T] and ids [B] of the parcels indices, as stacked by the default collate from __getitem__.
+        Times of the whole batch are subsampled at once (see sample_times), so the random draws differ from __getitem__
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        sequencelengths = self.sequencelengths[indices]
+
+        if self.samplet is None:
+            # pad up to maximum sequence length
+            times = np.repeat(np.arange(self.sequencelengths.max())[None, :], len(indices), axis=0)
+            valid = times < sequencelengths[:, None]
+            X = self.X.gather(indices, np.minimum(times, sequencelengths[:, None] - 1))
+            if self.X.values.dtype == np.uint16:
+                X = parcelio.scale(X)
+            X[~valid] = PADDING_VALUE
+            y = np.where(valid, self.y[indices][:, None], PADDING_VALUE)
+        else:
+            times = sample_times(sequencelengths, self.samplet)
+            X = self.X.gather(indices, times)
+            if self.X.values.dtype == np.uint16:
+                X = parcelio.scale(X)
+            y = np.repeat(self.y[indices][:, None], self.samplet, axis=1)
+
+        X = torch.from_numpy(X).type(torch.FloatTensor)
+        y = torch.from_numpy(y).type(torch.LongTensor)
+
+        return X, y, torch.from_numpy(self.ids[indices])
+
 if __name__=="__main__":
     root = "/data/BavarianCrops"
     classmapping = "/data/BavarianCrops/classmapping.isprs.csv"
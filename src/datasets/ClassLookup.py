@@ -0,0 +1,47 @@
+import numpy as np
+
+class ClassLookup(object):
+    """
+    Maps codes (e.g. nutzcodes 451, 411 or gafcodes) to class ids of a classmapping table with one vectorized
+    np.searchsorted over the sorted codes instead of a .loc lookup per code.
+
+    Arguments:
+        codes (array): code of each row of the classmapping. Rows without code (NaN) are ignored
+        ids (array): class id of each row. Duplicate codes map to the id of their first row
+    """
+
+    def __init__(self, codes, ids):
+        codes = np.asarray(codes)
+        ids = np.asarray(ids)
+        if codes.dtype.kind == "f":
+            ids = ids[~np.isnan(codes)]
+            codes = codes[~np.isnan(codes)]
+
+        self.codes, first = np.unique(codes.astype(np.int64), return_index=True)
+        self.ids = ids[first].astype(np.int64)
+
+    def contains(self, codes):
+        """true for codes that are in the classmapping"""
+        codes = np.asarray(codes, dtype=np.int64)
+        if len(self.codes) == 0:
+            return np.zeros(codes.shape, dtype=bool)
+        position = np.searchsorted(self.codes, codes)
+        position[position == len(self.codes)] = 0
+        return self.codes[position] == codes
+
+    def __call__(self, codes, unknown="raise"):
+        """
+        class ids of codes. unknown is the policy for codes that are not in the classmapping:
+        "raise" raises a KeyError, an integer (e.g. -1) is returned as class id of unknown codes
+        """
+        assert unknown == "raise" or isinstance(unknown, (int, np.integer))
+        codes = np.asarray(codes, dtype=np.int64)
+        known = self.contains(codes)
+
+        if unknown == "raise" and not known.all():
+            raise KeyError("codes {} not in classmapping".format(np.unique(codes[~known]).tolist()))
+
+        y = np.full(codes.shape, unknown if unknown != "raise" else -1, dtype=np.int64)
+        if len(self.codes) > 0:
+            y[known] = self.ids[np.searchsorted(self.codes, codes[known])]
+        return y
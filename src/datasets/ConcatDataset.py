@@ -2,6 +2,8 @@ import torch
 import numpy as np
 import bisect
 import warnings
+from torch.utils.data.dataloader import default_collate
+from datasets.batching import is_batch, PADDING_VALUE
 
 class ConcatDataset(torch.utils.data.Dataset):
     """
@@ -30,13 +32,15 @@ class ConcatDataset(torch.utils.data.Dataset):
         self.nclasses = datasets[0].nclasses
         self.mapping = datasets[0].mapping
         self.classes = datasets[0].classes
-        self.sequencelength = datasets[0].sequencelength
-        self.sequencelengths = datasets[0].sequencelengths
+        # lengths of all members. datasets without sequencelengths (GAFDataset) have sequences of equal length
+        self.sequencelengths = np.concatenate([d.sequencelengths if d.sequencelengths is not None
+                                               else np.full(len(d), d.sequencelength) for d in self.datasets])
+        self.sequencelength = max([d.sequencelength for d in self.datasets])
         self.ndims = datasets[0].ndims
-        self.classweights = datasets[0].classweights
         self.classname = datasets[0].classname
         self.klassenname = datasets[0].klassenname
         self.hist = np.array([d.hist for d in self.datasets]).sum(0)
+        self.classweights = 1 / self.hist
         self.partition = self.datasets[0].partition
 
         self.y = np.concatenate([d.y for d in self.datasets], axis=0)
@@ -46,6 +50,9 @@ class ConcatDataset(torch.utils.data.Dataset):
         return self.cumulative_sizes[-1]
 
     def __getitem__(self, idx):
+        if is_batch(idx):
+            return self.getbatch(idx)
+
         if idx < 0:
             if -idx > len(self):
                 raise ValueError("absolute value of index should not exceed dataset length")
@@ -57,6 +64,45 @@ class ConcatDataset(torch.utils.data.Dataset):
             sample_idx = idx - self.cumulative_sizes[dataset_idx - 1]
         return self.datasets[dataset_idx][sample_idx]
 
+    def getbatch(self, indices):
+        """
+        X, y and ids of a batch of global indices. The indices are grouped by dataset with one searchsorted and every
+        dataset fetches its group at once (getbatch or collated items). Shorter padded sequences are padded to the
+        longest of the batch
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if ((indices < 0) | (indices >= len(self))).any():
+            raise ValueError("absolute value of index should not exceed dataset length")
+
+        dataset_idxs = np.searchsorted(self.cumulative_sizes, indices, side="right")
+        starts = np.array([0] + self.cumulative_sizes[:-1])
+
+        groups = list()
+        for dataset_idx in np.unique(dataset_idxs):
+            positions = np.where(dataset_idxs == dataset_idx)[0]
+            dataset = self.datasets[dataset_idx]
+            sample_idxs = indices[positions] - starts[dataset_idx]
+            if hasattr(dataset, "getbatch"):
+                batch = dataset.getbatch(sample_idxs)
+            else:
+                batch = default_collate([dataset[i] for i in sample_idxs])
+            groups.append((positions, batch))
+
+        if len(groups) == 1:
+            return groups[0][1]
+
+        sequencelength = max([batch[0].shape[1] for _, batch in groups])
+        X = torch.full((len(indices), sequencelength, groups[0][1][0].shape[2]), PADDING_VALUE, dtype=torch.float)
+        y = torch.full((len(indices), sequencelength), PADDING_VALUE, dtype=torch.long)
+        ids = torch.zeros(len(indices), dtype=torch.long)
+        for positions, (X_, y_, ids_) in groups:
+            positions = torch.from_numpy(positions)
+            X[positions, :X_.shape[1]] = X_
+            y[positions, :y_.shape[1]] = y_
+            ids[positions] = ids_
+        return X, y, ids
+
     @property
     def cummulative_sizes(self):
         warnings.warn("cummulative_sizes attribute is renamed to "
@@ -12,6 +12,9 @@ from matplotlib.lines import Line2D
 from pandas.plotting import register_matplotlib_converters
 register_matplotlib_converters()
 import re
+import weakref
+from datasets import caching
+from datasets.ClassLookup import ClassLookup
 
 sns.set_style("white")
 
@@ -24,9 +27,52 @@ RADAR_BANDS = ["VH", "VV"]
 
 AGGREGATION_METHODS = ["mean", "median", "std", "p05", "p95"]
 
+# regions loaded in this process, shared by all partitions and feature selections of a region.
+# A region is released when the last GAFDataset that holds it is garbage collected
+_regions = weakref.WeakValueDictionary()
+
+class GAFRegion(object):
+    """
+    y, meta and the features of all parcels of a region loaded from the cache folder of the region.
+    The features are stored band-major in bands.npy [D x N x T]: every band is one contiguous chunk, so a feature
+    selection (e.g. features="radar") is read without touching the bytes of the other bands
+    """
+
+    def __init__(self, cache, mmap=True):
+        self.cache = cache
+        self.mmap = mmap
+        self.y = np.load(os.path.join(cache, "y.npy"))
+        self.meta = np.load(os.path.join(cache, "meta.npy"),allow_pickle=True)
+        self.gafids = self.meta[:, 2].astype(int)
+        self.selections = dict()
+
+    def features(self, bands):
+        """[D x N x T] features of the (sorted) band indices bands"""
+        key = tuple(bands)
+        if key not in self.selections:
+            # plain ndarray view of the memmap. Indexing np.memmap objects is considerably slower
+            X = np.load(os.path.join(self.cache, "bands.npy"), mmap_mode="r").view(np.ndarray)
+            if np.array_equal(bands, np.arange(bands[0], bands[-1] + 1)):
+                features = X[bands[0]:bands[-1] + 1]
+            else:
+                features = X[bands]
+            # With mmap the features are read from the page cache, which is also shared by DataLoader workers and
+            # processes. Otherwise only the selected bands are copied to memory
+            self.selections[key] = features if self.mmap else np.array(features)
+        return self.selections[key]
+
+def load_region(cache, cachekey, mmap=True):
+    """region of the cache folder. Loaded on first use and shared while any dataset holds it"""
+    key = (cache, cachekey, mmap)
+    region = _regions.get(key)
+    if region is None:
+        region = GAFRegion(cache, mmap=mmap)
+        _regions[key] = region
+    return region
+
 class GAFDataset(torch.utils.data.Dataset):
 
-    def __init__(self, path, region, partition, classmapping, scheme="random", overwrite_cache=True, features="all"):
+    def __init__(self, path, region, partition, classmapping, scheme="random", overwrite_cache=False, features="all", mmap=True):
         assert region in ["holl","nowa","krum"]
         assert scheme in ["random", "blocks"]
         assert region in ["holl","nowa","krum"]
@@ -40,40 +86,39 @@ class GAFDataset(torch.utils.data.Dataset):
         self.region = region
         self.partition = partition
 
-        self.X,self.y,self.meta = self.load_data()
+        # the cache is rebuilt when the hdf5 file changes (size or modification time) or the loader version changes
+        self.cachekey = self.hdf5_key()
 
-        """
         if not self.cache_exists() or overwrite_cache:
             self.save_cache()
+            _regions.pop((self.cache, self.cachekey, mmap), None)
 
-        self.X = np.load(os.path.join(self.cache, "X.npy"))
-        self.y = np.load(os.path.join(self.cache, "y.npy"))
-        self.meta = np.load(os.path.join(self.cache, "meta.npy"),allow_pickle=True)
-        """
-
-        # normalize optical bands
-        self.X[:,:,:14] *= 1e-4
-        self.X[:, :, 15] *= 1e-3
-        self.X[:, :, 17] *= 1e-2
+        # normalized features of all parcels of the region, loaded once per process.
+        # Partitions and feature sets only store indices into the arrays of the region
+        self.store = load_region(self.cache, self.cachekey, mmap=mmap)
 
         assert features in ["all", "optical", "radar"]
+        self.bands = np.arange(len(BANDS))
         if features=="optical":
             mask = np.isin(BANDS, OPTICAL_BANDS)
             print("features='optical': selecting {} optical features from all {} features".format(len(OPTICAL_BANDS),len(BANDS)))
-            self.X = self.X[:, :, mask]
+            self.bands = np.where(mask)[0]
 
         if features=="radar":
             mask = np.isin(BANDS, RADAR_BANDS)
             print("features='radar': selecting {} optical features from all {} features".format(len(RADAR_BANDS),
                                                                                                      len(BANDS)))
-            self.X = self.X[:,:,mask]
+            self.bands = np.where(mask)[0]
 
         def read(filename):
             with open(filename,'r') as f:
                 ids = [int(id.rstrip("\n")) for id in f.readlines()]
             return ids
 
-        gafids = self.meta[:, 2].astype(int)
+        # [D x N x T] features of the selected bands
+        self.features = self.store.features(self.bands)
+
+        gafids = self.store.gafids
 
         if scheme=="random":
             if partition not in ["train","test"]:
@@ -95,9 +140,9 @@ class GAFDataset(torch.utils.data.Dataset):
 
         mask = np.isin(gafids, ids)
 
-        self.X = self.X[mask]
-        self.y = self.y[mask]
-        self.meta = self.meta[mask]
+        self.index = np.where(mask)[0]
+        self.y = self.store.y[mask]
+        self.meta = self.store.meta[mask]
 
         #self.mean = self.X.mean(0).mean(0)
         #self.std = self.X.std(0).std(0)
@@ -106,6 +151,7 @@ class GAFDataset(torch.utils.data.Dataset):
 
         self.mapping = pd.read_csv(classmapping, index_col=0).sort_values(by="id")
         self.mapping = self.mapping.set_index("nutzcode")
+        self.lookup = ClassLookup(self.mapping.index.values, self.mapping["id"].values)
         self.classes = self.mapping["id"].unique()
         self.classname = self.mapping.groupby("id").first().classname.values
         self.klassenname = self.mapping.groupby("id").first().klassenname.values
@@ -116,21 +162,23 @@ class GAFDataset(torch.utils.data.Dataset):
         self.hist,_ = np.histogram(self.y, bins=self.nclasses)
         self.classweights = 1 / self.hist
 
-        delete_idxs = np.zeros(self.y.shape, dtype=bool)
-        delete_classes = list()
-        for y in np.unique(self.y):
-            if len(self.mapping.loc[self.mapping.gafcode == y])==0:
-                delete_idxs += (self.y == y)
-                delete_classes.append(y)
+        self.gaflookup = ClassLookup(self.mapping["gafcode"].values, self.mapping["id"].values)
+        delete_idxs = ~self.gaflookup.contains(self.y)
+        delete_classes = np.unique(self.y[delete_idxs]).tolist()
 
         if delete_idxs.sum() > 0:
             print(f"gaf classes {delete_classes} not in classmapping {classmapping}. ignoring {delete_idxs.sum()} "
                   f"examples ({(delete_idxs.sum() / len(self.y)) * 100:.2f}% of dataset)")
-            self.X = self.X[~delete_idxs]
+            self.index = self.index[~delete_idxs]
             self.y = self.y[~delete_idxs]
             self.meta = self.meta[~delete_idxs]
 
-        self.N, self.sequencelength, self.ndims = self.X.shape
+        # class id of each example resolved once, so __getitem__ only indexes arrays
+        self.classids = self.gaflookup(self.y)
+
+        self.N = len(self.index)
+        self.sequencelength = self.features.shape[2]
+        self.ndims = len(self.bands)
 
         print(self)
 
@@ -139,12 +187,8 @@ class GAFDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
 
-        X = self.X[idx]
-        y = self.y[idx]
-
-        y = self.mapping.loc[self.mapping.gafcode == y].id.iloc[0]
-
-        y = np.repeat(y,self.sequencelength)
+        X = np.ascontiguousarray(self.features[:, self.index[idx]].T)
+        y = np.repeat(self.classids[idx],self.sequencelength)
         #X -= self.mean
         #X /= self.std
 
@@ -153,9 +197,36 @@ class GAFDataset(torch.utils.data.Dataset):
 
         return X, y, int(self.meta[idx][2])
 
-    def applyclassmapping(self, nutzcodes):
-        """uses a mapping table to replace nutzcodes (e.g. 451, 411) with class ids"""
-        return np.array([self.mapping.loc[nutzcode]["id"] for nutzcode in nutzcodes])
+    def applyclassmapping(self, nutzcodes, unknown="raise"):
+        """
+        uses a mapping table to replace nutzcodes (e.g. 451, 411) with class ids.
+        Unknown nutzcodes raise a KeyError or are replaced by unknown if it is an integer. see ClassLookup
+        """
+        return self.lookup(nutzcodes, unknown=unknown)
+
+    def save_cache(self):
+        X, y, meta = self.load_data()
+
+        # normalize optical bands
+        X[:,:,:14] *= 1e-4
+        X[:, :, 15] *= 1e-3
+        X[:, :, 17] *= 1e-2
+
+        # written to a temporary folder that replaces the cache when complete
+        with caching.atomic_folder(self.cache) as folder:
+            # band-major [D x N x T]. float32 is the precision of the tensors returned by __getitem__
+            np.save(os.path.join(folder, "bands.npy"), np.ascontiguousarray(X.transpose(2, 0, 1), dtype=np.float32))
+            np.save(os.path.join(folder, "y.npy"), y)
+            np.save(os.path.join(folder, "meta.npy"), meta)
+            caching.write_key(folder, self.cachekey)
+
+    def hdf5_key(self):
+        """key of the hdf5 file from its size and modification time or None if only the cache is available"""
+        if not os.path.exists(self.hdf5_path):
+            return None
+        stat = os.stat(self.hdf5_path)
+        return caching.cache_key(hdf5=os.path.basename(self.hdf5_path), size=stat.st_size, mtime=stat.st_mtime_ns,
+                                 layout="bands")
 
     def load_data(self):
         print("saving npy arrays to " + self.cache)
@@ -195,10 +266,11 @@ class GAFDataset(torch.utils.data.Dataset):
         """
 
     def cache_exists(self):
-        a = os.path.exists(os.path.join(self.cache, "X.npy"))
+        a = os.path.exists(os.path.join(self.cache, "bands.npy"))
         b = os.path.exists(os.path.join(self.cache, "y.npy"))
         c = os.path.exists(os.path.join(self.cache, "meta.npy"))
-        return a and b and c
+        uptodate = self.cachekey is None or caching.read_key(self.cache) == self.cachekey
+        return a and b and c and uptodate
         """
         a = os.path.exists(os.path.join(self.cache, "Xtrain.npy"))
         b = os.path.exists(os.path.join(self.cache, "Xtest.npy"))
@@ -212,7 +284,7 @@ class GAFDataset(torch.utils.data.Dataset):
         """
 
     def __str__(self):
-        return "Dataset {}. region {}. partition {}. X:{}, y:{} with {} classes".format(self.hdf5_path, self.region, self.partition,self.X.shape, self.y.shape, self.nclasses)
+        return "Dataset {}. region {}. partition {}. X:{}, y:{} with {} classes".format(self.hdf5_path, self.region, self.partition,(self.N, self.sequencelength, self.ndims), self.y.shape, self.nclasses)
 
 def load_raw_dataset(path='./test_train.h5'):
     testset, trainset = load_dataset(path=path)
@@ -267,38 +339,46 @@ def load_dataset(path='./test_train.h5'):
 
     return testset, trainset
 
-def split_column_names_into_categories(cols):
-
-    """regex generator functions"""
-
-    def get_raw_pattern(band="B02"):
-        return ".*/" + band + "_[0-9]{4}-[0-9]{2}-[0-9]{2}_median"
-
-    def get_three_month_aggregate_pattern(band="B02", aggr="median"):
-        return ".*/" + band + "_median_(Jan|Feb|Mar|Apr|Mai|Jun|Jul|Aug|Sep|Oct|Nov|Dec){2}_" + aggr
+MONTHS = "(?:Jan|Feb|Mar|Apr|Mai|Jun|Jul|Aug|Sep|Oct|Nov|Dec)"
 
-    def get_annual_pattern(band="B02", aggr="median"):
-        return ".*/" + band + "_median_annual_" + aggr
+# raw time series "<prefix>/<band>_<yyyy-mm-dd>_median", three month aggregates "<prefix>/<band>_median_<months>_<aggr>"
+# and annual aggregates "<prefix>/<band>_median_annual_<aggr>" in one pattern, so each column name is parsed once
+COLUMN_PATTERN = re.compile(".*/(?P<band>" + "|".join(BANDS) + ")_(?:"
+                            + "(?P<raw>[0-9]{4}-[0-9]{2}-[0-9]{2}_median)"
+                            + "|median_" + MONTHS + "{2}_(?P<threemonths>" + "|".join(AGGREGATION_METHODS) + ")"
+                            + "|median_annual_(?P<annual>" + "|".join(AGGREGATION_METHODS) + "))")
 
+def split_column_names_into_categories(cols):
+    """
+    column names of each band and category: "raw" time series, "3m" three month and "a" annual aggregates.
+    As before, "3m" and "a" hold the columns of the last aggregation method (p95)
+    """
+    index = dict()
+    for band in BANDS:
+        index[band] = dict(raw=list(), threemonths=dict(), annual=dict())
+        for aggr in AGGREGATION_METHODS:
+            index[band]["threemonths"][aggr] = list()
+            index[band]["annual"][aggr] = list()
+
+    for i, col in enumerate(cols):
+        match = COLUMN_PATTERN.match(col)
+        if match is None:
+            continue
+        band = index[match.group("band")]
+        if match.group("raw") is not None:
+            band["raw"].append(i)
+        elif match.group("threemonths") is not None:
+            band["threemonths"][match.group("threemonths")].append(i)
+        else:
+            band["annual"][match.group("annual")].append(i)
+
+    aggr = AGGREGATION_METHODS[-1]
     categories = dict()
     for band in BANDS:
         categories[band] = dict()
-        r = re.compile(get_raw_pattern(band=band))
-        vmatch = np.vectorize(lambda x: bool(r.match(x)))
-        idx = vmatch(cols)
-
-        categories[band]["raw"] = cols[idx]
-
-        for aggr in AGGREGATION_METHODS:
-            r = re.compile(get_three_month_aggregate_pattern(band=band, aggr=aggr))
-            vmatch = np.vectorize(lambda x: bool(r.match(x)))
-            idx = vmatch(cols)
-            categories[band]["3m"] = cols[idx]
-
-            r = re.compile(get_annual_pattern(band=band, aggr=aggr))
-            vmatch = np.vectorize(lambda x: bool(r.match(x)))
-            idx = vmatch(cols)
-            categories[band]["a"] = cols[idx]
+        categories[band]["raw"] = cols[np.array(index[band]["raw"], dtype=int)]
+        categories[band]["3m"] = cols[np.array(index[band]["threemonths"][aggr], dtype=int)]
+        categories[band]["a"] = cols[np.array(index[band]["annual"][aggr], dtype=int)]
 
     return categories
 
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+from datasets.caching import save_atomic
+
+class PackedSequences(object):
+    """
+    Ragged list of [t x d] sequences stored as one contiguous values array [sum(t) x d] and an offsets index [N+1].
+    Sequence i is the view values[offsets[i]:offsets[i+1]], so indexing does not create python objects per sequence
+    and the cache can be stored without pickling.
+
+    Arguments:
+        values (numpy array): concatenated sequences [sum(t) x d]
+        offsets (numpy array): start of each sequence in values plus the total length [N+1]
+        index (numpy array): optional selection of sequences (e.g. the parcels of a partition) [M].
+            Sequence i is then sequence index[i] of values and offsets. see take()
+    """
+
+    def __init__(self, values, offsets, index=None):
+        assert offsets[0] == 0 and offsets[-1] == len(values)
+        self.values = values
+        self.offsets = offsets
+        self.index = index
+
+    @staticmethod
+    def from_list(sequences, dtype=np.float32):
+        sequencelengths = np.array([len(X) for X in sequences], dtype=np.int64)
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        np.cumsum(sequencelengths, out=offsets[1:])
+        if len(sequences) > 0:
+            values = np.concatenate(sequences, axis=0).astype(dtype, copy=False)
+        else:
+            values = np.zeros((0, 0), dtype=dtype)
+        return PackedSequences(values, offsets)
+
+    @staticmethod
+    def concatenate(sequences):
+        """PackedSequences with copies of the (selected) sequences of each PackedSequences in sequences"""
+        sequences = [packed.compact() for packed in sequences]
+        sequencelengths = np.concatenate([packed.sequencelengths for packed in sequences])
+        offsets = np.zeros(len(sequencelengths) + 1, dtype=np.int64)
+        np.cumsum(sequencelengths, out=offsets[1:])
+        values = np.concatenate([np.asarray(packed.values) for packed in sequences], axis=0)
+        return PackedSequences(values, offsets)
+
+    def compact(self):
+        """PackedSequences with a copy of the selected sequences only, or self if all sequences are selected"""
+        if self.index is None:
+            return self
+        sequencelengths = self.sequencelengths
+        offsets = np.zeros(len(sequencelengths) + 1, dtype=np.int64)
+        np.cumsum(sequencelengths, out=offsets[1:])
+        rows = np.repeat(self.offsets[self.index] - offsets[:-1], sequencelengths) + np.arange(offsets[-1])
+        return PackedSequences(np.asarray(self.values[rows]), offsets)
+
+    def take(self, indices):
+        """selection of sequences that shares values and offsets with this object"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.index is not None:
+            indices = self.index[indices]
+        return PackedSequences(self.values, self.offsets, index=indices)
+
+    @property
+    def sequencelengths(self):
+        sequencelengths = np.diff(self.offsets)
+        return sequencelengths if self.index is None else sequencelengths[self.index]
+
+    @property
+    def ndims(self):
+        return self.values.shape[1]
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.index is None else len(self.index)
+
+    def __getitem__(self, idx):
+        if self.index is not None:
+            idx = self.index[idx]
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def gather(self, indices, times):
+        """[B x T x d] values of the sequences indices at times [B x T] (positions within each sequence)"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.index is not None:
+            indices = self.index[indices]
+        return np.asarray(self.values[self.offsets[indices][:, None] + times])
+
+    def save(self, folder):
+        assert self.index is None, "save the PackedSequences that holds all sequences"
+        save_atomic(os.path.join(folder, "values.npy"), self.values)
+        save_atomic(os.path.join(folder, "offsets.npy"), self.offsets)
+
+    @staticmethod
+    def exists(folder):
+        """true if packed arrays are cached in folder"""
+        return os.path.exists(os.path.join(folder, "values.npy")) and os.path.exists(os.path.join(folder, "offsets.npy"))
+
+    @staticmethod
+    def load(folder, mmap_mode=None):
+        """
+        loads values and offsets.
+        With mmap_mode="r" values are memory-mapped read-only: all processes that open the same cache (e.g. DataLoader
+        workers or concurrent training runs) share one copy of the data in the page cache.
+        """
+        values = np.load(os.path.join(folder, "values.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(folder, "offsets.npy"))
+        return PackedSequences(values, offsets)
@@ -0,0 +1,333 @@
+import os
+import numpy as np
+from datasets import parcelio
+from datasets import caching
+from datasets import resampling
+from datasets.PackedSequences import PackedSequences
+
+class ParcelStore(object):
+    """
+    Parcels of one region, parsed once from <data_folder>/<id>.csv (or a RegionFile) and cached in folder as packed
+    arrays (values, offsets) with ids, nutzcodes and a manifest of the parsed files.
+
+    The store holds every parcel of the region that has at least one valid time, independent of classmapping and
+    partition. Partitions (train, valid, test, trainvalid) select their parcels with index(), so each csv file
+    is parsed once and the data of the region is stored once. dates holds the date of acquisition of every row of
+    X.values.
+
+    New acquisitions of parcels in the store are added with append() as delta segments in <folder>/deltas without
+    parsing the csv files again. load() reads the base arrays and the delta segments that are complete at that
+    moment, so every reader sees a consistent snapshot. consolidate() folds the delta segments into the base arrays.
+    update() and consolidate() replace the delta segments with new base arrays. They raise an error instead if another
+    process has appended a segment since this store was loaded.
+
+    Arguments:
+        folder (str): cache folder of the region
+        data_folder (str): folder of the <id>.csv files
+        workers (int): number of processes parsing csv files
+        mmap (bool): memory-map the cached values to share them between processes
+        compact (bool): store uint16 digital numbers instead of float32 reflectances (see parcelio.scale)
+        region_file (RegionFile): read the parcels from this region file instead of the csv files in data_folder
+    """
+
+    def __init__(self, folder, data_folder, workers=1, mmap=True, compact=False, region_file=None):
+        self.folder = folder
+        self.data_folder = data_folder
+        self.workers = workers
+        self.mmap = mmap
+        self.compact = compact
+        self.region_file = region_file
+        self.key = ParcelStore.cache_key(compact)
+
+        self.X = None
+        self.dates = None
+        self.ids = None
+        self.nutzcodes = None
+        self.manifest = None
+        # names of the delta segments held by X and dates, None if the store has not been loaded
+        self.merged_deltas = None
+
+    @staticmethod
+    def cache_key(compact=False):
+        """key of the store. compact stores get their own key, so both layouts can be cached side by side"""
+        return caching.cache_key(dtype="uint16") if compact else caching.cache_key()
+
+    def exists(self):
+        manifestexists = os.path.exists(os.path.join(self.folder, "manifest.npy"))
+        datesexist = os.path.exists(os.path.join(self.folder, "dates.npy"))
+        return caching.read_key(self.folder) == self.key and manifestexists and datesexist and \
+               PackedSequences.exists(self.folder)
+
+    def load(self):
+        self.ids = np.load(os.path.join(self.folder, "ids.npy"))
+        self.nutzcodes = np.load(os.path.join(self.folder, "nutzcodes.npy"))
+        self.manifest = np.load(os.path.join(self.folder, "manifest.npy"))
+        self.X = PackedSequences.load(self.folder, mmap_mode="r" if self.mmap else None)
+        self.dates = np.load(os.path.join(self.folder, "dates.npy"), mmap_mode="r" if self.mmap else None)
+
+        deltas = self.deltas()
+        self.merged_deltas = [os.path.basename(delta) for delta in deltas]
+        if len(deltas) > 0:
+            # X and dates are merged in memory and no longer memory-mapped until the next consolidate()
+            print("merging {} delta segments of {}".format(len(deltas), self.folder))
+            self.merge([self.load_delta(delta) for delta in deltas])
+
+    def consistent(self, ids):
+        """true if the store was built from exactly these (sorted, unique) ids"""
+        return np.array_equal(self.manifest[:, 0], ids)
+
+    def update(self, ids, incremental=True):
+        """
+        Makes the store hold the parcels of ids (sorted, unique).
+
+        With incremental=True the manifest (id, size and modification time of every csv file) tells which files are
+        new or changed. Only those are parsed. Parcels of unchanged files are copied from the loaded store (with their
+        appended acquisitions) and parcels of removed ids or files are dropped. Otherwise all csv files are parsed.
+        The parcels of a region file have the size and modification time of the region file, so all of them are read
+        again when it changes. Acquisitions appended to parcels that are parsed again are replaced by their csv file.
+        """
+        if self.region_file is not None:
+            manifest = self.region_file.stat(ids)
+        else:
+            manifest = parcelio.stat_parcels(ids, self.data_folder)
+
+        incremental = incremental and self.manifest is not None
+        if incremental:
+            if np.array_equal(manifest, self.manifest):
+                print("cached dataset is up to date")
+                return
+            unchanged = parcelio.unchanged_parcels(manifest, self.manifest)
+            cached_position = dict((id, i) for i, id in enumerate(self.ids.tolist()))
+        else:
+            unchanged = np.zeros(len(ids), dtype=bool)
+
+        exists = manifest[:, 1] >= 0
+        parse_ids = [id for id, parse in zip(ids, exists & ~unchanged) if parse]
+        if self.region_file is not None:
+            print("reading {} of {} parcels from {}".format(len(parse_ids), len(ids), self.region_file.path))
+            parsed = self.region_file.load_parcels(parse_ids, compact=self.compact, dates=True)
+        else:
+            print("parsing {} of {} csv files".format(len(parse_ids), len(ids)))
+            parsed = parcelio.load_parcels(parse_ids, self.data_folder, workers=self.workers, compact=self.compact,
+                                           dates=True)
+
+        X_list = list()
+        dates = list()
+        nutzcodes = list()
+        store_ids = list()
+        for i, id in enumerate(ids):
+
+            if unchanged[i]:
+                # parcels without valid times were dropped in the last build and stay dropped
+                if id in cached_position:
+                    X_list.append(self.X[cached_position[id]])
+                    dates.append(self.parcel_dates(cached_position[id]))
+                    nutzcodes.append(self.nutzcodes[cached_position[id]])
+                    store_ids.append(id)
+                continue
+
+            X, nutzcode, doa = None, None, None
+            if exists[i]:
+                _, _, X, nutzcode, doa = next(parsed)
+
+            if X is None:
+                manifest[i, 1:] = -1
+            elif len(nutzcode) > 0:
+                X_list.append(X)
+                dates.append(doa)
+                nutzcodes.append(nutzcode[0])
+                store_ids.append(id)
+
+        self.X = PackedSequences.from_list(X_list, dtype=np.uint16 if self.compact else np.float32)
+        self.dates = np.concatenate(dates).astype("datetime64[D]") if len(dates) > 0 else np.zeros(0, "datetime64[D]")
+        self.nutzcodes = np.array(nutzcodes, dtype=np.int64)
+        self.ids = np.array(store_ids, dtype=np.int64)
+        self.manifest = manifest
+
+        self.save()
+
+        if self.mmap:
+            # release the private copy and read X from the page cache like a later run would
+            self.load()
+
+    def save(self):
+        # written to a temporary folder that replaces the cache (and its delta segments) when complete
+        with caching.atomic_folder(self.folder) as folder:
+            np.save(os.path.join(folder, "ids.npy"), self.ids)
+            np.save(os.path.join(folder, "nutzcodes.npy"), self.nutzcodes)
+            np.save(os.path.join(folder, "manifest.npy"), self.manifest)
+            np.save(os.path.join(folder, "dates.npy"), self.dates)
+            self.X.save(folder)
+            caching.write_key(folder, self.key)
+            self.check_deltas()
+        self.merged_deltas = list()
+
+    def check_deltas(self):
+        """raises an error if the store folder holds delta segments that are not merged into this store"""
+        if self.merged_deltas is None:
+            # built without loading a valid store. Segments of the previous store do not belong to this one
+            return
+        new = sorted(set(os.path.basename(delta) for delta in self.deltas()) - set(self.merged_deltas))
+        if len(new) > 0:
+            raise RuntimeError("delta segments {} were appended to {} after it was loaded and would be lost. "
+                               "Load the store again and repeat".format(new, self.folder))
+
+    def consolidate(self):
+        """
+        writes the loaded store with its merged delta segments as new base arrays. Raises an error if another process
+        has appended a segment after this store was loaded
+        """
+        self.save()
+        if self.mmap:
+            self.load()
+
+    def resampled(self, grid):
+        """
+        PackedSequences of all parcels resampled onto the dates of grid (see resampling.resample). Computed once and
+        cached in <folder>/grid.<key> for the grid and the delta segments of the store. The cache is removed with
+        the store when it is rebuilt or consolidated
+        """
+        deltas = ",".join([os.path.basename(delta) for delta in self.deltas()])
+        key = caching.cache_key(grid=",".join(np.asarray(grid).astype("datetime64[D]").astype(str)), deltas=deltas)
+        folder = os.path.join(self.folder, "grid." + key)
+        if caching.read_key(folder) != key:
+            print("resampling {} parcels onto {} dates".format(len(self.ids), len(grid)))
+            X = resampling.resample(self.X, self.dates, grid)
+            with caching.atomic_folder(folder) as tmpfolder:
+                X.save(tmpfolder)
+                caching.write_key(tmpfolder, key)
+        return PackedSequences.load(folder, mmap_mode="r" if self.mmap else None)
+
+    def parcel_dates(self, position):
+        """dates of acquisition of the parcel at position of the store"""
+        return self.dates[self.X.offsets[position]:self.X.offsets[position + 1]]
+
+    def append(self, ids, dates, X):
+        """
+        Appends new acquisitions to parcels of the store as a delta segment, without parsing the csv files again.
+
+        ids [M], dates [M] (datetime64 or iso strings) and digital numbers X [M x 13] of the BANDS are the new
+        observations. Observations with nans are dropped like times of the csv files. The dates of a parcel must be
+        later than its last date in the store. This store holds the new acquisitions afterwards, other processes see
+        them when they load the store the next time.
+
+        returns the number of appended acquisitions
+        """
+        assert self.X is not None, "load or update the store before appending"
+        ids = np.asarray(ids, dtype=np.int64)
+        dates = np.asarray(dates).astype("datetime64[D]")
+        X = np.asarray(X, dtype=np.float64)
+        assert len(ids) == len(dates) == len(X) and X.shape[1] == len(parcelio.BANDS)
+
+        valid = ~np.isnan(X).any(1)
+        ids, dates, X = ids[valid], dates[valid], X[valid]
+
+        position = self.index(ids)
+        if (position < 0).any():
+            raise KeyError("parcels {} not in the store".format(np.unique(ids[position < 0]).tolist()))
+
+        order = np.lexsort((dates, position))
+        position, dates, X = position[order], dates[order], X[order]
+        parcels, first, sequencelengths = np.unique(position, return_index=True, return_counts=True)
+
+        later = np.ones(len(dates), dtype=bool)
+        later[1:] = (dates[1:] > dates[:-1]) | (position[1:] != position[:-1])
+        later[first] = dates[first] > self.dates[self.X.offsets[parcels + 1] - 1]
+        if not later.all():
+            raise ValueError("acquisitions of parcels {} are not later than their last acquisition".format(
+                np.unique(self.ids[position[~later]]).tolist()))
+
+        offsets = np.zeros(len(parcels) + 1, dtype=np.int64)
+        np.cumsum(sequencelengths, out=offsets[1:])
+        delta = (self.ids[parcels], dates, PackedSequences(parcelio.encode(X, compact=self.compact,
+                                                                           source="appended acquisitions"), offsets))
+        self.merged_deltas.append(os.path.basename(self.save_delta(delta)))
+        self.merge([delta])
+        return len(dates)
+
+    def deltas(self):
+        """folders of the complete delta segments in the order of appending"""
+        folder = os.path.join(self.folder, "deltas")
+        if not os.path.exists(folder):
+            return list()
+        return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.isdigit()]
+
+    def save_delta(self, delta):
+        """
+        writes a delta segment (ids, dates, X) to a temporary folder that is renamed to the next segment number.
+        returns the folder of the segment
+        """
+        ids, dates, X = delta
+        folder = os.path.join(self.folder, "deltas")
+        os.makedirs(folder, exist_ok=True)
+        tmpfolder = os.path.join(folder, "{}.tmp".format(os.getpid()))
+        os.makedirs(tmpfolder, exist_ok=True)
+        np.save(os.path.join(tmpfolder, "ids.npy"), ids)
+        np.save(os.path.join(tmpfolder, "dates.npy"), dates)
+        X.save(tmpfolder)
+
+        while True:
+            deltas = self.deltas()
+            number = int(os.path.basename(deltas[-1])) + 1 if len(deltas) > 0 else 0
+            segment = os.path.join(folder, "{:06d}".format(number))
+            try:
+                # fails if a concurrent process has written a segment with the same number first
+                os.rename(tmpfolder, segment)
+                return segment
+            except OSError:
+                if not os.path.exists(tmpfolder):
+                    raise
+
+    @staticmethod
+    def load_delta(folder):
+        ids = np.load(os.path.join(folder, "ids.npy"))
+        dates = np.load(os.path.join(folder, "dates.npy"))
+        return ids, dates, PackedSequences.load(folder)
+
+    def merge(self, deltas):
+        """
+        X and dates of the store with the acquisitions of the delta segments (ids, dates, X) appended to the sequences
+        of their parcels, in the order of deltas
+        """
+        sequencelengths = self.X.sequencelengths.copy()
+        positions = list()
+        for ids, _, X in deltas:
+            position = self.index(ids)
+            assert (position >= 0).all(), "delta segment of parcels that are not in the store"
+            sequencelengths[position] += X.sequencelengths
+            positions.append(position)
+
+        offsets = np.zeros(len(sequencelengths) + 1, dtype=np.int64)
+        np.cumsum(sequencelengths, out=offsets[1:])
+        values = np.empty((offsets[-1], self.X.ndims), dtype=self.X.values.dtype)
+        dates = np.empty(offsets[-1], dtype="datetime64[D]")
+
+        # rows of each sequence are copied behind the rows copied into the same sequence before
+        segments = [(np.arange(len(self.ids)), self.dates, self.X)]
+        segments += [(position, segmentdates, X) for position, (_, segmentdates, X) in zip(positions, deltas)]
+        cursor = offsets[:-1].copy()
+        for position, segmentdates, X in segments:
+            rows = np.repeat(cursor[position] - X.offsets[:-1], X.sequencelengths) + np.arange(len(X.values))
+            values[rows] = X.values
+            dates[rows] = segmentdates
+            cursor[position] += X.sequencelengths
+
+        self.X = PackedSequences(values, offsets)
+        self.dates = dates
+
+    def index(self, ids):
+        """position of each id in the store or -1 if the store holds no parcel with this id"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        position = np.searchsorted(self.ids, ids)
+        position[position == len(self.ids)] = 0
+        return np.where(self.ids[position] == ids, position, -1)
+
+    def missing(self, ids):
+        """true for ids whose csv file did not exist when the store was built"""
+        ids = np.asarray(ids, dtype=np.int64)
+        position = np.searchsorted(self.manifest[:, 0], ids)
+        position[position == len(self.manifest)] = 0
+        known = self.manifest[position, 0] == ids
+        return ~known | (self.manifest[position, 1] < 0)
@@ -0,0 +1,156 @@
+import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+import tqdm
+from datasets import parcelio
+
+QA_COLUMNS = ['QA10', 'QA20', 'QA60']
+DATE_COLUMN = parcelio.DATE_COLUMN
+
+def read_parcel_frame(csv_file):
+    """
+    all columns of a parcel csv file as DataFrame [t x 18] with the columns of RegionFile.
+    Numbers are parsed with round_trip precision, so the bands hold the same float64 values as read_parcel_csv
+    """
+    frame = pd.read_csv(csv_file, index_col=0, float_precision="round_trip")
+    columns = parcelio.BANDS + QA_COLUMNS + [parcelio.LABEL_COLUMN]
+    frame = frame[columns + [DATE_COLUMN]].astype(dict((column, np.float64) for column in columns))
+    frame[DATE_COLUMN] = pd.to_datetime(frame[DATE_COLUMN])
+    return frame.reset_index(drop=True)
+
+class RegionFile(object):
+    """
+    All parcels of a region in one hdf5 file (pandas HDFStore) instead of one csv file per parcel.
+
+    The table "parcels" holds the rows of all csv files ordered by parcel id and time with the columns id, BANDS,
+    QA10, QA20, QA60 and label (float64) and doa (datetime). The table "index" holds the id and the first and end row
+    of each parcel, so parcels are read in row ranges without a query on the id column.
+
+    Written once from the csv files with RegionFile.convert (see convert_parcels.py). ParcelStore reads the parcels
+    from the region file instead of the csv files if one is given.
+
+    Arguments:
+        path (str): path of the hdf5 file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = pd.read_hdf(self.path, "index")
+        return self._index
+
+    @staticmethod
+    def convert(data_folder, path, workers=1, chunksize=1000):
+        """
+        writes the parcels of all <data_folder>/<id>.csv files to the region file path. csv files are parsed by a pool
+        of workers processes and appended in chunks of chunksize parcels. The file is written to a temporary file
+        that replaces path when complete
+        """
+        names = [f[:-len(".csv")] for f in os.listdir(data_folder) if f.endswith(".csv")]
+        ids = sorted([int(name) for name in names if name.isdigit()])
+        csv_files = [os.path.join(data_folder, "{}.csv".format(id)) for id in ids]
+        print("converting {} csv files in {} to {}".format(len(ids), data_folder, path))
+
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpfile = "{}.{}.tmp".format(path, os.getpid())
+
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            if pool is not None:
+                frames = pool.imap(read_parcel_frame, csv_files, chunksize=16)
+            else:
+                frames = map(read_parcel_frame, csv_files)
+
+            sequencelengths = list()
+            chunk = list()
+            with pd.HDFStore(tmpfile, "w", complevel=5, complib="blosc") as store:
+                for id, frame in tqdm.tqdm(zip(ids, frames), total=len(ids)):
+                    frame.insert(0, "id", np.int64(id))
+                    chunk.append(frame)
+                    sequencelengths.append(len(frame))
+                    if len(chunk) == chunksize:
+                        store.append("parcels", pd.concat(chunk, ignore_index=True), index=False)
+                        chunk = list()
+                if len(chunk) > 0:
+                    store.append("parcels", pd.concat(chunk, ignore_index=True), index=False)
+
+                stop = np.cumsum(sequencelengths, dtype=np.int64)
+                store.put("index", pd.DataFrame(dict(id=np.array(ids, dtype=np.int64), start=stop - sequencelengths,
+                                                     stop=stop)))
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        os.replace(tmpfile, path)
+        print("wrote {} rows of {} parcels to {}".format(int(stop[-1]) if len(stop) > 0 else 0, len(ids), path))
+
+    def stat(self, ids):
+        """
+        manifest [N x 3] of id, size and modification time (ns) like parcelio.stat_parcels, with the size and
+        modification time of the region file for every id in the file and -1 for the other ids
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        stat = os.stat(self.path)
+        manifest = np.full((len(ids), 3), -1, dtype=np.int64)
+        manifest[:, 0] = ids
+        manifest[self.position(ids) >= 0, 1:] = [stat.st_size, stat.st_mtime_ns]
+        return manifest
+
+    def position(self, ids):
+        """row of each id in the index or -1 if the file holds no parcel with this id"""
+        fileids = self.index["id"].values
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(fileids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        position = np.searchsorted(fileids, ids)
+        position[position == len(fileids)] = 0
+        return np.where(fileids[position] == ids, position, -1)
+
+    def load_parcels(self, ids, compact=False, dates=False, chunksize=10000):
+        """
+        Yields (id, path, X, nutzcodes) in the order of ids (sorted) like parcelio.load_parcels, with X and nutzcodes
+        parsed like read_parcel_csv and the dates of acquisition as fifth value if dates=True.
+        X and nutzcodes are None if the file holds no parcel with this id.
+        The table is read in row ranges of up to chunksize parcels, each row at most once
+        """
+        position = self.position(ids)
+        start = self.index["start"].values
+        stop = self.index["stop"].values
+        columns = parcelio.BANDS + [parcelio.LABEL_COLUMN]
+        selected = columns + ([DATE_COLUMN] if dates else [])
+
+        with pd.HDFStore(self.path, "r") as store:
+            rows, first = None, None
+            for id, p in tqdm.tqdm(zip(ids, position), total=len(ids)):
+                if p < 0:
+                    yield (id, self.path) + (None,) * (3 if dates else 2)
+                    continue
+
+                if rows is None or p < first or p >= first + chunksize:
+                    # next range of parcels that starts at this parcel
+                    first = p
+                    end = min(first + chunksize, len(start))
+                    frame = store.select("parcels", start=start[first], stop=stop[end - 1], columns=selected)
+                    rows = frame[columns].values
+                    if dates:
+                        doa = frame[DATE_COLUMN].values.astype("datetime64[D]")
+
+                rows_of_parcel = slice(start[p] - start[first], stop[p] - start[first])
+                parsed = parcelio.parse_rows(rows[rows_of_parcel].astype(np.float64), compact=compact,
+                                             source="parcel {} of {}".format(id, self.path),
+                                             dates=doa[rows_of_parcel] if dates else None)
+                yield (id, self.path) + parsed
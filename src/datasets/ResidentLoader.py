@@ -0,0 +1,117 @@
+import torch
+import numpy as np
+from datasets.PackedSequences import PackedSequences
+from datasets import parcelio
+
+PADDING_VALUE = -1
+
+class ResidentLoader(object):
+    """
+    Iterates over batches of a dataset that is materialized once as tensors on the training device.
+    Replaces a DataLoader for datasets that fit in (GPU) memory: batches are assembled with tensor indexing on the
+    device, so there are no worker processes, pickling and collating per batch.
+
+    Datasets with PackedSequences X (BavarianCropsDataset, VNRiceDataset) are copied as packed values and the random
+    time subsampling of samplet times is done per batch on the device. Digital numbers of compact datasets stay
+    integers on the device and are scaled to reflectances per batch. Other datasets (e.g. GAFDataset) are copied
+    item by item once and returned as they are.
+
+    Arguments:
+        dataset (Dataset): dataset or ConcatDataset of datasets. Stays available as loader.dataset
+        batch_size (int): number of samples per batch
+        shuffle (bool): new random order of the samples every epoch
+        drop_last (bool): skip the last batch if it is smaller than batch_size
+        device (torch.device): training device. Defaults to cuda if available
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, device=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.device = device
+
+        datasets = dataset.datasets if hasattr(dataset, "datasets") else [dataset]
+        packed = [isinstance(getattr(d, "X", None), PackedSequences) for d in datasets]
+        samplets = set([getattr(d, "samplet", None) if p else None for d, p in zip(datasets, packed)])
+        assert len(samplets) == 1, "all datasets must sample the same number of times"
+        self.samplet = samplets.pop()
+
+        X = list()
+        y = list()
+        ids = list()
+        for d, p in zip(datasets, packed):
+            if p:
+                X.append(d.X)
+                y.append(np.asarray(d.y))
+                ids.append(np.asarray(d.ids))
+            else:
+                items = [d[i] for i in range(len(d))]
+                X.append(PackedSequences.from_list([item[0].numpy() for item in items]))
+                y.append(np.array([int(item[1][0]) for item in items]))
+                ids.append(np.array([int(item[2]) for item in items]))
+        compact = [X_.values.dtype == np.uint16 for X_ in X]
+        if any(compact) and not all(compact):
+            # reflectances for all datasets if compact and float32 datasets are mixed
+            X = [X_.compact() for X_ in X]
+            X = [PackedSequences(parcelio.scale(X_.values), X_.offsets) if c else X_ for X_, c in zip(X, compact)]
+        packed = PackedSequences.concatenate(X)
+
+        # digital numbers as the smallest integer type of torch that holds them (torch has no uint16)
+        self.compact = all(compact)
+        if self.compact:
+            dtype = np.int16 if packed.values.max(initial=0) <= np.iinfo(np.int16).max else np.int32
+            packed.values = packed.values.astype(dtype)
+
+        self.values = torch.from_numpy(packed.values).to(device)
+        self.offsets = torch.from_numpy(packed.offsets[:-1]).to(device)
+        self.sequencelengths = torch.from_numpy(packed.sequencelengths).to(device)
+        self.y = torch.from_numpy(np.concatenate(y).astype(np.int64)).to(device)
+        self.ids = torch.from_numpy(np.concatenate(ids).astype(np.int64)).to(device)
+        self.sequencelength = int(packed.sequencelengths.max())
+
+        if self.samplet is not None and packed.sequencelengths.min() < self.samplet:
+            raise ValueError("cannot sample {} times from sequences of length {}".format(self.samplet,
+                                                                                          packed.sequencelengths.min()))
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.y) // self.batch_size
+        return (len(self.y) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.y), device=self.device)
+        else:
+            order = torch.arange(len(self.y), device=self.device)
+
+        for i in range(len(self)):
+            yield self.batch(order[i * self.batch_size:(i + 1) * self.batch_size])
+
+    def batch(self, indices):
+        """X [B x T x D], y [B x T] and ids [B] of indices, as returned by the datasets"""
+        sequencelengths = self.sequencelengths[indices][:, None]
+        times = torch.arange(self.sequencelength, device=self.device)[None, :].expand(len(indices), -1)
+
+        if self.samplet is None:
+            # pad up to maximum sequence length
+            valid = times < sequencelengths
+            X = self.scale(self.values[self.offsets[indices][:, None] + torch.min(times, sequencelengths - 1)])
+            X[~valid] = PADDING_VALUE
+            y = torch.where(valid, self.y[indices][:, None], torch.full_like(times, PADDING_VALUE))
+        else:
+            # samplet times with the smallest uniform random keys, like np.random.choice(t, samplet, replace=False)
+            keys = torch.rand(times.shape, device=self.device).masked_fill(times >= sequencelengths, float("inf"))
+            sampled = keys.topk(self.samplet, dim=1, largest=False)[1].sort(dim=1)[0]
+            X = self.scale(self.values[self.offsets[indices][:, None] + sampled])
+            y = self.y[indices][:, None].expand(-1, self.samplet)
+
+        return X, y, self.ids[indices]
+
+    def scale(self, X):
+        """reflectances of gathered values. Same float32 values as parcelio.scale"""
+        if not self.compact:
+            return X
+        return (X.double() * parcelio.NORMALIZING_FACTOR).float()
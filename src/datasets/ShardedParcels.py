@@ -0,0 +1,193 @@
+import os
+import glob
+import numpy as np
+import torch
+import torch.utils.data
+from datasets.PackedSequences import PackedSequences
+from datasets import parcelio
+
+PADDING_VALUE = -1
+
+def write_shards(dataset, folder, shardsize=10000, seed=0):
+    """
+    writes the parcels of a dataset (e.g. a ConcatDataset of BavarianCropsDataset regions) to compressed shards
+    <folder>/shard-<i>.npz of shardsize parcels each, with packed values and offsets, class ids y and ids.
+    The parcels are shuffled once before sharding, so every shard holds a mix of regions and classes.
+    info.npz holds the class information and statistics of the whole dataset and the number of parcels of each shard.
+    Only the parcels of one shard are copied into memory at a time, the values stay in the (memory mapped) stores of
+    the datasets
+    """
+    datasets = dataset.datasets if hasattr(dataset, "datasets") else [dataset]
+    y = np.concatenate([d.y for d in datasets]).astype(np.int64)
+    ids = np.concatenate([d.ids for d in datasets]).astype(np.int64)
+    sequencelengths = np.concatenate([d.X.sequencelengths for d in datasets])
+    # dataset of each parcel and its index within this dataset
+    member = np.repeat(np.arange(len(datasets)), [len(d.X) for d in datasets])
+    memberindex = np.concatenate([np.arange(len(d.X)) for d in datasets])
+
+    os.makedirs(folder, exist_ok=True)
+    order = np.random.RandomState(seed).permutation(len(y))
+    shardsizes = list()
+    for shard, start in enumerate(range(0, len(order), shardsize)):
+        indices = order[start:start + shardsize]
+        # gather the parcels of each dataset at once, then restore the shuffled order
+        bydataset = np.argsort(member[indices], kind="stable")
+        grouped = indices[bydataset]
+        packed = PackedSequences.concatenate([datasets[d].X.take(memberindex[grouped[member[grouped] == d]])
+                                              for d in np.unique(member[grouped])])
+        packed = packed.take(np.argsort(bydataset)).compact()
+        np.savez_compressed(os.path.join(folder, "shard-{:05d}.npz".format(shard)), values=packed.values,
+                            offsets=packed.offsets, y=y[indices], ids=ids[indices])
+        shardsizes.append(len(indices))
+
+    np.savez(os.path.join(folder, "info.npz"), nclasses=dataset.nclasses, classes=dataset.classes,
+             classname=np.array(dataset.classname, dtype=str), klassenname=np.array(dataset.klassenname, dtype=str),
+             hist=dataset.hist,
+             sequencelengths=sequencelengths, ndims=datasets[0].X.ndims, shardsizes=np.array(shardsizes, dtype=np.int64))
+    print("wrote {} parcels to {} shards in {}".format(len(y), len(shardsizes), folder))
+
+class ShardedParcelDataset(torch.utils.data.IterableDataset):
+    """
+    Streams parcels from the shards of write_shards without holding the dataset in memory.
+    Yields (X, y, id) items like BavarianCropsDataset.__getitem__.
+
+    Every epoch the shard order and the parcel order within each shard are shuffled (the same way on all ranks and
+    workers). The shuffled parcels are split into consecutive ranges of ceil(N / world_size) parcels per distributed
+    rank, which the DataLoader workers of a rank split again, so every rank streams the same number of parcels and
+    runs the same number of steps under DDP. The range of the last rank continues with the first parcels of the epoch,
+    so up to world_size - 1 parcels are streamed twice per epoch. Parcels of the open shards pass through a shuffle
+    buffer of buffersize parcels.
+
+    Arguments:
+        folder (str): folder of the shards
+        samplet (int): number of sampled times per parcel or None to pad to the maximum sequence length
+        shuffle (bool): shuffle shards and parcels
+        buffersize (int): number of parcels in the shuffle buffer
+        seed (int): seed of the shuffling. Combined with the epoch (see set_epoch)
+        rank, world_size (int): distributed rank and number of ranks. Default: from torch.distributed if initialized
+        partition (str): name of the partition for logging
+    """
+
+    def __init__(self, folder, samplet=70, shuffle=True, buffersize=10000, seed=0, rank=None, world_size=None,
+                 partition="train"):
+        self.shards = sorted(glob.glob(os.path.join(folder, "shard-*.npz")))
+        assert len(self.shards) > 0, "no shards found in " + folder
+        self.samplet = samplet
+        self.shuffle = shuffle
+        self.buffersize = buffersize
+        self.seed = seed
+        self.epoch = 0
+        self.partition = partition
+
+        if rank is None or world_size is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+
+        info = np.load(os.path.join(folder, "info.npz"))
+        self.nclasses = int(info["nclasses"])
+        self.classes = info["classes"]
+        self.classname = info["classname"]
+        self.klassenname = info["klassenname"]
+        self.hist = info["hist"]
+        self.classweights = 1 / self.hist
+        self.sequencelengths = info["sequencelengths"]
+        self.sequencelength = self.sequencelengths.max()
+        self.ndims = int(info["ndims"])
+        self.shardsizes = info["shardsizes"]
+        assert len(self.shardsizes) == len(self.shards), "info.npz does not match the shards in " + folder
+
+    def __len__(self):
+        """number of parcels per rank and epoch"""
+        return -(-int(self.shardsizes.sum()) // self.world_size)
+
+    def set_epoch(self, epoch):
+        """new shard and parcel order. Call before each epoch with the same epoch on all ranks"""
+        self.epoch = epoch
+
+    def worker_ranges(self):
+        """
+        (shard, positions) of the parcels of this rank and DataLoader worker in the order of the epoch, with the
+        positions of the parcels in the shuffled order of the shard
+        """
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.shards))
+        first = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(self.shardsizes[order], out=first[1:])
+
+        start, stop = self.rank * len(self), (self.rank + 1) * len(self)
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            # the same split on every rank, so all ranks load the same number of batches
+            bounds = start + len(self) * np.arange(worker.num_workers + 1) // worker.num_workers
+            start, stop = bounds[worker.id], bounds[worker.id + 1]
+
+        positions = np.arange(start, stop) % first[-1]
+        shards = np.searchsorted(first, positions, side="right") - 1
+        changes = np.flatnonzero(np.diff(shards)) + 1
+        for run in np.split(np.arange(len(positions)), changes):
+            if len(run) > 0:
+                shard = shards[run[0]]
+                yield order[shard], positions[run] - first[shard]
+
+    def parcels(self, ranges):
+        for shard, positions in ranges:
+            with np.load(self.shards[shard]) as data:
+                X = PackedSequences(data["values"], data["offsets"])
+                y, ids = data["y"], data["ids"]
+            # the same order of the shard on all ranks and workers that read a part of it
+            order = np.arange(len(y))
+            if self.shuffle:
+                order = np.random.RandomState([self.seed, self.epoch, shard]).permutation(len(y))
+            for i in order[positions]:
+                yield X[i], y[i], ids[i]
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        workerid = worker.id if worker is not None else 0
+        random = np.random.RandomState([self.seed, self.epoch, self.rank, workerid])
+
+        parcels = self.parcels(self.worker_ranges())
+        if not self.shuffle:
+            for parcel in parcels:
+                yield self.item(parcel, random)
+            return
+
+        buffer = list()
+        for parcel in parcels:
+            if len(buffer) < self.buffersize:
+                buffer.append(parcel)
+                continue
+            # emit a random parcel of the buffer and put the new parcel in its place
+            i = random.randint(len(buffer))
+            yield self.item(buffer[i], random)
+            buffer[i] = parcel
+
+        for i in random.permutation(len(buffer)):
+            yield self.item(buffer[i], random)
+
+    def item(self, parcel, random):
+        X, y, id = parcel
+        t = X.shape[0]
+        if X.dtype == np.uint16:
+            # shards of compact datasets hold digital numbers
+            X = parcelio.scale(X)
+
+        if self.samplet is None:
+            # pad up to maximum sequence length
+            npad = self.sequencelength - t
+            X = np.pad(X, [(0, npad), (0, 0)], 'constant', constant_values=PADDING_VALUE)
+            y = np.pad(np.full(t, y), (0, npad), 'constant', constant_values=PADDING_VALUE)
+        else:
+            idxs = random.choice(t, self.samplet, replace=False)
+            idxs.sort()
+            X = X[idxs]
+            y = np.full(self.samplet, y)
+
+        X = torch.from_numpy(X).type(torch.FloatTensor)
+        y = torch.from_numpy(y).type(torch.LongTensor)
+
+        return X, y, id
@@ -0,0 +1,109 @@
+import numpy as np
+import torch
+import torch.utils.data
+from torch.utils.data.sampler import Sampler, BatchSampler, RandomSampler, SequentialSampler
+
+PADDING_VALUE = -1
+
+def is_batch(idx):
+    """true if idx is a list or array of indices (as yielded by a BatchSampler) instead of a single index"""
+    return isinstance(idx, (list, tuple, np.ndarray, torch.Tensor)) and np.ndim(idx) == 1
+
+def sample_times(sequencelengths, samplet):
+    """
+    sorted random subsets of samplet times of every sequence [B x samplet], drawn without replacement like
+    np.random.choice(t, samplet, replace=False) per sequence, but for the whole batch in one vectorized operation:
+    times are ordered by uniform random keys and the first samplet are kept. Times beyond the length get infinite keys.
+    """
+    sequencelengths = np.asarray(sequencelengths)
+    if (sequencelengths < samplet).any():
+        raise ValueError("cannot sample {} times from sequences of length {}".format(samplet, sequencelengths.min()))
+
+    keys = np.random.rand(len(sequencelengths), sequencelengths.max())
+    keys[np.arange(keys.shape[1])[None, :] >= sequencelengths[:, None]] = np.inf
+    times = np.argpartition(keys, samplet - 1, axis=1)[:, :samplet]
+    times.sort(axis=1)
+    return times
+
+def batch_dataloader(dataset, batch_size, shuffle=False, num_workers=0, drop_last=False):
+    """
+    DataLoader that fetches whole batches with dataset[indices] instead of batch_size calls of dataset[idx].
+    The BatchSampler yields the indices of a batch and batch_size=None disables the collate step,
+    since the dataset returns ready batch tensors
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return torch.utils.data.DataLoader(dataset=dataset, sampler=BatchSampler(sampler, batch_size, drop_last),
+                                       batch_size=None, num_workers=num_workers)
+
+def pad_collate(batch):
+    """
+    collates (X, y, id) items of different lengths and pads them only to the longest sequence of the batch.
+    Padding of the items (times with label PADDING_VALUE, e.g. from samplet=None) is removed first.
+    Returns X [B x T x D], y [B x T], ids [B], lengths [B] and mask [B x T] (true for times within the sequence)
+    """
+    lengths = torch.tensor([int((y != PADDING_VALUE).sum()) for _, y, _ in batch])
+    sequencelength = int(lengths.max())
+    ndims = batch[0][0].shape[1]
+
+    X = torch.full((len(batch), sequencelength, ndims), PADDING_VALUE, dtype=torch.float)
+    y = torch.full((len(batch), sequencelength), PADDING_VALUE, dtype=torch.long)
+    for i, (X_, y_, _) in enumerate(batch):
+        X[i, :lengths[i]] = X_[:lengths[i]]
+        y[i, :lengths[i]] = y_[:lengths[i]]
+    ids = torch.from_numpy(np.array([int(id) for _, _, id in batch], dtype=np.int64))
+    mask = torch.arange(sequencelength)[None, :] < lengths[:, None]
+
+    return X, y, ids, lengths, mask
+
+class LengthBucketSampler(Sampler):
+    """
+    Yields batches of indices of sequences with similar length, so pad_collate pads little.
+    The indices are shuffled, split into buckets of bucketsize batches and sorted by length within each bucket.
+    The order of the batches is shuffled again, so batches of short and long sequences alternate
+
+    Arguments:
+        sequencelengths (array): length of every sequence of the dataset
+        batch_size (int): number of indices per batch
+        shuffle (bool): random buckets and batch order every epoch. Otherwise batches of sorted lengths
+        bucketsize (int): number of batches per bucket
+        drop_last (bool): skip the last batch of a bucket if it is smaller than batch_size
+    """
+
+    def __init__(self, sequencelengths, batch_size, shuffle=True, bucketsize=100, drop_last=False):
+        self.sequencelengths = np.asarray(sequencelengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucketsize = bucketsize
+        self.drop_last = drop_last
+
+    def batches(self):
+        if not self.shuffle:
+            order = np.argsort(self.sequencelengths, kind="stable")
+            buckets = [order]
+        else:
+            order = np.random.permutation(len(self.sequencelengths))
+            step = self.batch_size * self.bucketsize
+            buckets = [order[start:start + step] for start in range(0, len(order), step)]
+
+        batches = list()
+        for bucket in buckets:
+            bucket = bucket[np.argsort(self.sequencelengths[bucket], kind="stable")]
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        n = len(self.sequencelengths)
+        step = n if not self.shuffle else self.batch_size * self.bucketsize
+        bucketsizes = [min(step, n - start) for start in range(0, n, step)]
+        if self.drop_last:
+            return sum([size // self.batch_size for size in bucketsizes])
+        return sum([(size + self.batch_size - 1) // self.batch_size for size in bucketsizes])
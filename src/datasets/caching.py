@@ -0,0 +1,77 @@
+import os
+import shutil
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+
+# increment if the content or layout of the cached arrays changes
+LOADER_VERSION = 2
+
+def hash_file(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_key(files=(), **parameters):
+    """
+    content address of a cache: sha1 over the loader version, the content of files (e.g. the classmapping)
+    and parameters (e.g. split parameters). Any change of these inputs leads to a different key.
+    """
+    h = hashlib.sha1()
+    h.update("version={};".format(LOADER_VERSION).encode())
+    for filename in files:
+        h.update("{};".format(hash_file(filename)).encode())
+    for name in sorted(parameters.keys()):
+        h.update("{}={};".format(name, parameters[name]).encode())
+    return h.hexdigest()[:16]
+
+def write_key(folder, key):
+    with open(os.path.join(folder, "key.txt"), "w") as f:
+        f.write(key)
+
+def read_key(folder):
+    """key stored in a cache folder or None if the cache has no key (e.g. written by earlier versions)"""
+    if not os.path.exists(os.path.join(folder, "key.txt")):
+        return None
+    with open(os.path.join(folder, "key.txt"), "r") as f:
+        return f.read().strip()
+
+def save_atomic(filename, array):
+    """np.save to a temporary file and rename it, so processes that memory-map filename never see a partial file"""
+    tmpfile = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmpfile, "wb") as f:
+        np.save(f, array)
+    os.replace(tmpfile, filename)
+
+@contextmanager
+def atomic_folder(folder):
+    """
+    yields a temporary folder that replaces folder once the with block has completed.
+    An interrupted build leaves the previous content of folder untouched and never a half-written cache.
+    """
+    os.makedirs(os.path.dirname(folder), exist_ok=True)
+    tmpfolder = "{}.{}.tmp".format(folder, os.getpid())
+    if os.path.exists(tmpfolder):
+        shutil.rmtree(tmpfolder)
+    os.makedirs(tmpfolder)
+
+    try:
+        yield tmpfolder
+    except BaseException:
+        shutil.rmtree(tmpfolder, ignore_errors=True)
+        raise
+
+    if os.path.exists(folder):
+        # files of the old folder that are memory-mapped by other processes stay valid until they are closed
+        oldfolder = "{}.{}.old".format(folder, os.getpid())
+        os.rename(folder, oldfolder)
+        os.rename(tmpfolder, folder)
+        shutil.rmtree(oldfolder, ignore_errors=True)
+    else:
+        try:
+            os.rename(tmpfolder, folder)
+        except OSError:
+            # a concurrent process has finished the same cache first
+            shutil.rmtree(tmpfolder, ignore_errors=True)
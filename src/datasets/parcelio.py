@@ -0,0 +1,159 @@
+import os
+import multiprocessing
+from functools import partial
+import pandas as pd
+import numpy as np
+import tqdm
+
+BANDS = ['B1', 'B10', 'B11', 'B12', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8',
+       'B8A', 'B9']
+NORMALIZING_FACTOR = 1e-4
+LABEL_COLUMN = "label"
+DATE_COLUMN = "doa"
+
+def read_parcel_csv(csv_file, engine="numpy", compact=False, dates=False):
+    """
+    column projected reader for parcel csv files. header:
+    ['B1', 'B10', 'B11', 'B12', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8',
+    'B8A', 'B9', 'QA10', 'QA20', 'QA60', 'doa', 'label', 'id']
+
+    Only the BANDS and the label column are converted to numbers and times that contain nans in these columns are
+    dropped in the same pass. engine "numpy" tokenizes the file once in python, "pandas" uses pd.read_csv with usecols.
+
+    returns X [t x 13] float32 reflectances (scaled by NORMALIZING_FACTOR) and nutzcodes [t] int64.
+    With compact=True X holds the unscaled uint16 digital numbers, which scale() converts to reflectances.
+    With dates=True the datetime64[D] dates of acquisition [t] of the doa column are returned as third value
+    """
+    columns = BANDS + [LABEL_COLUMN]
+    doa = None
+
+    if engine == "pandas":
+        frame = pd.read_csv(csv_file, usecols=columns + ([DATE_COLUMN] if dates else []),
+                            dtype=dict((column, np.float64) for column in columns))
+        data = frame[columns].values
+        if dates:
+            doa = pd.to_datetime(frame[DATE_COLUMN]).values.astype("datetime64[D]")
+
+    elif engine == "numpy":
+        with open(csv_file, "rb") as f:
+            header = f.readline().decode().strip().split(",")
+            text = f.read().replace(b"\r", b"")
+
+        ncols = len(header)
+        lines = text.split(b"\n")
+        while len(lines) > 0 and lines[-1] == b"":
+            # trailing newline
+            lines.pop()
+        fields = np.array([line.count(b",") + 1 for line in lines], dtype=np.int64)
+        if (fields != ncols).any():
+            row = int(np.flatnonzero(fields != ncols)[0])
+            raise ValueError("{} line {} has {} fields instead of {}".format(csv_file, row + 2, fields[row], ncols))
+
+        t = len(lines)
+        tokens = b",".join(lines).split(b",") if t > 0 else []
+        table = np.array(tokens, dtype=object).reshape(t, ncols)
+        data = table[:, [header.index(c) for c in columns]]
+        data[data == b""] = b"nan"
+        data = data.astype(np.float64)
+        if dates:
+            doa = table[:, header.index(DATE_COLUMN)].astype(bytes).astype("datetime64[s]").astype("datetime64[D]")
+
+    else:
+        raise ValueError("engine must be either 'numpy' or 'pandas'")
+
+    return parse_rows(data, compact=compact, source=csv_file, dates=doa)
+
+def parse_rows(data, compact=False, source="parcel", dates=None):
+    """
+    X and nutzcodes of the float64 rows [t x 14] of one parcel with the BANDS and the label column, as returned by
+    read_parcel_csv. source names the parcel in error messages. dates of the rows [t] are returned for the valid
+    times as third value if given
+    """
+    X = data[:, :len(BANDS)]
+
+    # drop times that contain nans, also in the label column (a nan nutzcode has no int64 value)
+    valid = ~np.isnan(data[:, :len(BANDS) + 1]).any(1)
+
+    X = encode(X[valid], compact=compact, source=source)
+    nutzcodes = data[valid, len(BANDS)].astype(np.int64)
+
+    if dates is not None:
+        return X, nutzcodes, dates[valid]
+    return X, nutzcodes
+
+def encode(X, compact=False, source="parcel"):
+    """
+    float32 reflectances or, with compact=True, uint16 digital numbers of digital numbers X. A ValueError is raised
+    if compact digital numbers would not be exact
+    """
+    if compact:
+        if ((X < 0) | (X > np.iinfo(np.uint16).max) | (X != np.round(X))).any():
+            raise ValueError("{} holds reflectances that are no uint16 digital numbers".format(source))
+        return X.astype(np.uint16)
+    return scale(X)
+
+def scale(X):
+    """float32 reflectances of digital numbers X"""
+    # scaling in float64 and casting afterwards gives the same float32 values as the former float64 cache
+    return (X.astype(np.float64) * NORMALIZING_FACTOR).astype(np.float32)
+
+def load(csv_file, load_pandas = False, compact=False, dates=False):
+    """['B1', 'B10', 'B11', 'B12', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8',
+   'B8A', 'B9', 'QA10', 'QA20', 'QA60', 'doa', 'label', 'id']"""
+    return read_parcel_csv(csv_file, engine="pandas" if load_pandas else "numpy", compact=compact, dates=dates)
+
+def load_parcels(ids, data_folder, workers=1, load_pandas=False, compact=False, dates=False):
+    """
+    Parses <data_folder>/<id>.csv of every id with a pool of workers processes (serial if workers <= 1).
+
+    Yields (id, id_file, X, nutzcodes) in the order of ids. X and nutzcodes are None if the id_file does not exist.
+    With dates=True the dates of acquisition follow as fifth value (see read_parcel_csv).
+    Results are identical to calling load() on each file in sequence.
+    """
+    id_files = [data_folder + "/{id}.csv".format(id=id) for id in ids]
+    exists = [os.path.exists(id_file) for id_file in id_files]
+    existing_files = [id_file for id_file, e in zip(id_files, exists) if e]
+
+    load_file = partial(load, load_pandas=load_pandas, compact=compact, dates=dates)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        # imap keeps the input order. small chunks keep the progressbar responsive
+        chunksize = max(1, min(64, len(existing_files) // (workers * 8)))
+        results = pool.imap(load_file, existing_files, chunksize=chunksize)
+    else:
+        pool = None
+        results = map(load_file, existing_files)
+
+    try:
+        results = iter(results)
+        for id, id_file, e in tqdm.tqdm(zip(ids, id_files, exists), total=len(ids)):
+            if e:
+                yield (id, id_file) + tuple(next(results))
+            else:
+                yield (id, id_file) + (None,) * (3 if dates else 2)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def stat_parcels(ids, data_folder):
+    """
+    manifest [N x 3] of id, size and modification time (ns) of <data_folder>/<id>.csv for every id.
+    size and modification time are -1 if the file does not exist
+    """
+    manifest = np.full((len(ids), 3), -1, dtype=np.int64)
+    manifest[:, 0] = ids
+    for i, id in enumerate(ids):
+        try:
+            stat = os.stat(data_folder + "/{id}.csv".format(id=id))
+            manifest[i, 1] = stat.st_size
+            manifest[i, 2] = stat.st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return manifest
+
+def unchanged_parcels(manifest, cached_manifest):
+    """true for each row of manifest if the file was parsed with the same size and modification time before"""
+    cached = dict((row[0], (row[1], row[2])) for row in cached_manifest.tolist())
+    return np.array([cached.get(id) == (size, mtime) for id, size, mtime in manifest.tolist()], dtype=bool)
@@ -0,0 +1,60 @@
+import numpy as np
+from datasets import parcelio
+from datasets.PackedSequences import PackedSequences
+
+def date_grid(start, end, step):
+    """datetime64[D] dates from start to end (inclusive) every step days, e.g. date_grid("2018-01-01", "2018-12-31", 5)"""
+    return np.arange(np.datetime64(start, "D"), np.datetime64(end, "D") + 1, int(step))
+
+def resample(X, dates, grid, chunksize=2000):
+    """
+    Resamples all sequences of X (PackedSequences without index) with the dates of acquisition of its rows onto the
+    dates of grid by linear interpolation between the acquisitions before and after each grid date. Grid dates before
+    the first or after the last acquisition of a sequence take its first or last values.
+
+    returns PackedSequences of float32 reflectances (uint16 digital numbers are scaled) with len(grid) times per
+    sequence. values.reshape(len(X), len(grid), ndims) is the dense N x T x D array
+    """
+    assert X.index is None, "resample the PackedSequences that holds all sequences"
+    griddays = np.asarray(grid).astype("datetime64[D]").astype(np.int64)
+    days = np.asarray(dates).astype("datetime64[D]").astype(np.int64)
+    N, T = len(X), len(griddays)
+
+    offsets = np.arange(N + 1, dtype=np.int64) * T
+    values = np.empty((N * T, X.ndims), dtype=np.float32)
+    if N == 0 or T == 0:
+        return PackedSequences(values, offsets)
+
+    # (sequence, day) keys are searched in one np.searchsorted per chunk of sequences
+    first = min(days.min(), griddays.min())
+    span = max(days.max(), griddays.max()) - first + 1
+
+    for start in range(0, N, chunksize):
+        end = min(N, start + chunksize)
+        rows = np.arange(X.offsets[start], X.offsets[end])
+        sequence = np.repeat(np.arange(end - start), np.diff(X.offsets[start:end + 1]))
+        order = np.lexsort((days[rows], sequence))
+        rows = rows[order]
+        keys = sequence[order] * span + (days[rows] - first)
+
+        querykeys = np.arange(end - start)[:, None] * span + (griddays - first)[None, :]
+        after = np.searchsorted(keys, querykeys, side="right")
+
+        # acquisitions before and after each grid date, clipped to the sequence
+        lower = X.offsets[start:end, None] - X.offsets[start]
+        upper = X.offsets[start + 1:end + 1, None] - X.offsets[start] - 1
+        left = rows[np.clip(after - 1, lower, upper)]
+        right = rows[np.clip(after, lower, upper)]
+
+        distance = days[right] - days[left]
+        weight = np.where(distance > 0, (griddays[None, :] - days[left]) / np.maximum(distance, 1), 0.)[:, :, None]
+
+        X_left, X_right = np.asarray(X.values[left]), np.asarray(X.values[right])
+        if X.values.dtype == np.uint16:
+            X_left, X_right = parcelio.scale(X_left), parcelio.scale(X_right)
+        X_left, X_right = X_left.astype(np.float64), X_right.astype(np.float64)
+
+        resampled = (1 - weight) * X_left + weight * X_right
+        values[start * T:end * T] = resampled.reshape(-1, X.ndims)
+
+    return PackedSequences(values, offsets)
@@ -4,6 +4,9 @@ from sklearn.base import BaseEstimator
 
 class ClassificationModel(ABC,torch.nn.Module, BaseEstimator):
 
+    # models with forward(x, lengths=None) ignore the padded times after lengths [B] of each sequence
+    accepts_lengths = False
+
     def __init__(self):
         super().__init__()
 
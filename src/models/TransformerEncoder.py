@@ -9,6 +9,10 @@ from models.transformer.Models import Encoder
 SEQUENCE_PADDINGS_VALUE=-1
 
 class TransformerEncoder(ClassificationModel):
+
+    # forward masks the padded times of batches given with their lengths
+    accepts_lengths = True
+
     def __init__(self, in_channels=13, len_max_seq=100,
             d_word_vec=512, d_model=512, d_inner=2048,
             n_layers=6, n_head=8, d_k=64, d_v=64,
@@ -36,7 +40,7 @@ class TransformerEncoder(ClassificationModel):
 
         self.logsoftmax = nn.LogSoftmax(dim=-1)
 
-    def _logits(self, x):
+    def _logits(self, x, lengths=None):
         # b,d,t - > b,t,d
         x = x.transpose(1,2)
 
@@ -50,22 +54,35 @@ class TransformerEncoder(ClassificationModel):
         batchsize, seq, d = x.shape
         src_pos = torch.arange(1, seq + 1, dtype=torch.long).expand(batchsize, seq)
 
+        padding_mask = None
+        if lengths is not None:
+            padding_mask = src_pos > lengths.to(src_pos.device)[:, None]
+            # position 0 is the zero position encoding of padded times
+            src_pos = src_pos.masked_fill(padding_mask, 0)
+
         if torch.cuda.is_available():
             src_pos = src_pos.cuda()
+            if padding_mask is not None:
+                padding_mask = padding_mask.cuda()
 
-        enc_output, enc_slf_attn_list = self.encoder.forward(src_seq=x, src_pos=src_pos, return_attns=True)
+        enc_output, enc_slf_attn_list = self.encoder.forward(src_seq=x, src_pos=src_pos, return_attns=True,
+                                                             padding_mask=padding_mask)
 
         enc_output = self.outlayernorm(enc_output)
 
-        enc_output = self.tempmaxpool(enc_output.transpose(1, 2)).squeeze(-1)
+        if padding_mask is None:
+            enc_output = self.tempmaxpool(enc_output.transpose(1, 2)).squeeze(-1)
+        else:
+            # maximum over the times of each sequence. batches are shorter than len_max_seq
+            enc_output = enc_output.masked_fill(padding_mask.unsqueeze(-1), float("-inf")).max(1)[0]
 
         logits = self.outlinear(enc_output)
 
         return logits, None, None, None
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
 
-        logits, *_ = self._logits(x)
+        logits, *_ = self._logits(x, lengths=lengths)
 
         logprobabilities = self.logsoftmax(logits)
 
@@ -11,6 +11,10 @@ def entropy(p):
     return -(p*torch.log(p)).sum(1)
 
 class RNN(ClassificationModel):
+
+    # forward skips the padded times of batches given with their lengths
+    accepts_lengths = True
+
     def __init__(self, input_dim=1, hidden_dims=3, nclasses=5, num_rnn_layers=1, dropout=0.2, bidirectional=False,
                  use_batchnorm=False, use_attention=False, use_layernorm=True):
 
@@ -43,7 +47,7 @@ class RNN(ClassificationModel):
             self.bn = nn.BatchNorm1d(hidden_dims)
 
 
-    def _logits(self, x):
+    def _logits(self, x, lengths=None):
 
         # b,d,t -> b,t,d
         x = x.transpose(1,2)
@@ -51,7 +55,13 @@ class RNN(ClassificationModel):
         if self.use_layernorm:
             x = self.inlayernorm(x)
 
-        outputs, last_state_list = self.lstm.forward(x)
+        if lengths is None:
+            outputs, last_state_list = self.lstm.forward(x)
+        else:
+            # the lstm stops at the last time of each sequence. c holds the states at these times
+            packed = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            outputs, last_state_list = self.lstm.forward(packed)
+            outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True, total_length=x.shape[1])
 
         h, c = last_state_list
         if self.use_attention:
@@ -81,8 +91,8 @@ class RNN(ClassificationModel):
 
         return logits, None, pts, None
 
-    def forward(self,x):
-        logits, deltas, pts, budget = self._logits(x)
+    def forward(self, x, lengths=None):
+        logits, deltas, pts, budget = self._logits(x, lengths=lengths)
 
         logprobabilities = F.log_softmax(logits, dim=-1)
         # stack the lists to new tensor (b,d,t,h,w)
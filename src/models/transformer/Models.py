@@ -77,14 +77,19 @@ class Encoder(nn.Module):
             EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout=dropout)
             for _ in range(n_layers)])
 
-    def forward(self, src_seq, src_pos, return_attns=False):
+    def forward(self, src_seq, src_pos, return_attns=False, padding_mask=None):
 
         enc_slf_attn_list = []
 
         # -- Prepare masks
         #slf_attn_mask = get_attn_key_pad_mask(seq_k=src_seq, seq_q=src_seq)
-        slf_attn_mask = torch.zeros((src_seq.shape[0],src_seq.shape[1],src_seq.shape[1]),dtype=torch.uint8)
-        non_pad_mask = get_non_pad_mask(src_seq)
+        if padding_mask is None:
+            slf_attn_mask = torch.zeros((src_seq.shape[0],src_seq.shape[1],src_seq.shape[1]),dtype=torch.uint8)
+            non_pad_mask = get_non_pad_mask(src_seq)
+        else:
+            # padding_mask [b x t] is true for padded times: no attention to them and zero outputs at them
+            slf_attn_mask = padding_mask.unsqueeze(1).expand(-1, src_seq.shape[1], -1).type(torch.uint8)
+            non_pad_mask = (~padding_mask).type(torch.float).unsqueeze(-1)
 
         if torch.cuda.is_available():
             slf_attn_mask = slf_attn_mask.cuda()
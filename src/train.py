@@ -12,9 +12,12 @@ from models.rnn import RNN
 from datasets.ConcatDataset import ConcatDataset
 from datasets.GAFDataset import GAFDataset
 from datasets.BavarianCrops_Dataset import BavarianCropsDataset
+from datasets.ResidentLoader import ResidentLoader
+from datasets.batching import LengthBucketSampler, pad_collate, batch_dataloader
+from datasets.resampling import date_grid
 import argparse
 from utils.trainer import Trainer
-from torch.utils.data.sampler import RandomSampler, SequentialSampler
+from torch.utils.data.sampler import SequentialSampler
 from utils.texparser import parse_run
 from utils.logger import Logger
 from utils.visdomLogger import VisdomLogger
@@ -49,6 +52,17 @@ def parse_args():
         '--checkpoint_every_n_epochs', type=int, default=5, help='save checkpoints during training')
     parser.add_argument(
         '--seed', type=int, default=0, help='seed for batching and weight initialization')
+    parser.add_argument('--resident', action='store_true',
+                        help="keep the datasets as tensors on the training device instead of loading batches in workers")
+    parser.add_argument('--compact', action='store_true',
+                        help="store reflectances as uint16 digital numbers and scale them when loading batches")
+    parser.add_argument('--lightweight_test', action='store_true',
+                        help="test epochs only compute loss and confusion matrix. predictions, probabilities and ids "
+                             "are stored for the best (kappa) and the last test epoch only. These come from a re-evaluation "
+                             "after training with the stored weights and random state of those epochs")
+    parser.add_argument('--grid', type=str, nargs=3, default=None, metavar=("START", "END", "STEP"),
+                        help="resample all parcels onto the dates from START to END every STEP days, "
+                             "e.g. --grid 2018-01-01 2018-12-31 5. Replaces the sampling of samplet times")
     parser.add_argument(
         '--hparamset', type=int, default=0, help='rank of hyperparameter set 0: best hyperparameter')
     parser.add_argument(
@@ -59,6 +73,10 @@ def parse_args():
 
 def prepare_dataset(args):
 
+    # resampled parcels have the same times and are not sampled
+    grid = date_grid(*args.grid) if getattr(args, "grid", None) is not None else None
+    samplet = None if grid is not None else args.samplet
+
     if args.dataset == "BavarianCrops":
         root = os.path.join(args.dataroot,"BavarianCrops")
 
@@ -67,24 +85,28 @@ def prepare_dataset(args):
         for region in args.testregions:
             test_dataset_list.append(
                 BavarianCropsDataset(root=root, region=region, partition=args.test_on,
-                                            classmapping=args.classmapping, samplet=args.samplet,
-                                     scheme=args.scheme,mode=args.mode, seed=args.seed)
+                                            classmapping=args.classmapping, samplet=samplet,
+                                     scheme=args.scheme,mode=args.mode, seed=args.seed, workers=args.workers,
+                                     compact=getattr(args, "compact", False), grid=grid)
             )
 
         train_dataset_list = list()
         for region in args.trainregions:
             train_dataset_list.append(
                 BavarianCropsDataset(root=root, region=region, partition=args.train_on,
-                                            classmapping=args.classmapping, samplet=args.samplet,
-                                     scheme=args.scheme,mode=args.mode, seed=args.seed)
+                                            classmapping=args.classmapping, samplet=samplet,
+                                     scheme=args.scheme,mode=args.mode, seed=args.seed, workers=args.workers,
+                                     compact=getattr(args, "compact", False), grid=grid)
             )
 
     if args.dataset == "VNRice":
-        train_dataset_list=[VNRiceDataset(root=args.root, partition=args.train_on, samplet=args.samplet,
-                                          mode=args.mode, seed=args.seed)]
+        train_dataset_list=[VNRiceDataset(root=args.root, partition=args.train_on, samplet=samplet,
+                                          mode=args.mode, seed=args.seed, workers=args.workers,
+                                          compact=getattr(args, "compact", False), grid=grid)]
 
-        test_dataset_list=[VNRiceDataset(root=args.root, partition=args.test_on, samplet=args.samplet,
-                                         mode=args.mode, seed=args.seed)]
+        test_dataset_list=[VNRiceDataset(root=args.root, partition=args.test_on, samplet=samplet,
+                                         mode=args.mode, seed=args.seed, workers=args.workers,
+                                         compact=getattr(args, "compact", False), grid=grid)]
 
     if args.dataset == "BreizhCrops":
         root = "/home/marc/projects/BreizhCrops/data"
@@ -124,13 +146,31 @@ def prepare_dataset(args):
         torch.random.manual_seed(args.seed)
 
     traindataset = ConcatDataset(train_dataset_list)
-    traindataloader = torch.utils.data.DataLoader(dataset=traindataset, sampler=RandomSampler(traindataset),
-                                                  batch_size=args.batchsize, num_workers=args.workers)
-
     testdataset = ConcatDataset(test_dataset_list)
 
-    testdataloader = torch.utils.data.DataLoader(dataset=testdataset, sampler=SequentialSampler(testdataset),
-                                                 batch_size=args.batchsize, num_workers=args.workers)
+    if getattr(args, "resident", False):
+        # copied once to the training device. batches are assembled there without DataLoader workers
+        traindataloader = ResidentLoader(traindataset, args.batchsize, shuffle=True)
+        testdataloader = ResidentLoader(testdataset, args.batchsize)
+        return traindataloader, testdataloader
+
+    if samplet is None and grid is None:
+        # full sequences: batches of similar lengths, padded to the longest sequence of each batch. The items are not
+        # padded and the lengths of the batch are passed to models that skip padded times (rnn, transformer)
+        for dataset in traindataset.datasets + testdataset.datasets:
+            dataset.pad_items = False
+        traindataloader = torch.utils.data.DataLoader(dataset=traindataset, num_workers=args.workers,
+                                                      batch_sampler=LengthBucketSampler(traindataset.sequencelengths, args.batchsize),
+                                                      collate_fn=pad_collate)
+        testdataloader = torch.utils.data.DataLoader(dataset=testdataset, sampler=SequentialSampler(testdataset),
+                                                     batch_size=args.batchsize, num_workers=args.workers,
+                                                     collate_fn=pad_collate)
+        return traindataloader, testdataloader
+
+    # whole batches are fetched at once from the datasets instead of item by item
+    traindataloader = batch_dataloader(traindataset, args.batchsize, shuffle=True, num_workers=args.workers)
+
+    testdataloader = batch_dataloader(testdataset, args.batchsize, shuffle=False, num_workers=args.workers)
 
     return traindataloader, testdataloader
 
@@ -151,11 +191,14 @@ def train(args):
         args.hyperparameterfolder = hyperparameterfolder
 
     traindataloader, testdataloader = prepare_dataset(args)
+    if getattr(args, "grid", None) is not None:
+        # models that depend on the number of times get the number of grid dates
+        args.samplet = traindataloader.dataset.sequencelength
 
     args.nclasses = traindataloader.dataset.nclasses
     classname = traindataloader.dataset.classname
     klassenname = traindataloader.dataset.klassenname
-    args.seqlength = traindataloader.dataset.sequencelength
+    args.seqlength = max(traindataloader.dataset.sequencelength, testdataloader.dataset.sequencelength)
     #args.seqlength = args.samplet
     args.input_dims = traindataloader.dataset.ndims
 
@@ -191,7 +234,8 @@ def train(args):
         checkpoint_every_n_epochs=args.checkpoint_every_n_epochs,
         test_every_n_epochs=args.test_every_n_epochs,
         logger=logger,
-        optimizer=optimizer
+        optimizer=optimizer,
+        lightweight_test=getattr(args, "lightweight_test", False)
     )
 
     trainer = Trainer(model,traindataloader,testdataloader,**config)
@@ -231,7 +275,8 @@ def getModel(args):
         hidden_dims = args.hidden_dims # 256
         n_heads = args.n_heads # 8
         n_layers = args.n_layers # 6
-        len_max_seq = args.samplet
+        # full sequences (samplet=None) are padded to at most the longest sequence of the datasets
+        len_max_seq = args.samplet if args.samplet is not None else args.seqlength
         dropout = args.dropout
         d_inner = hidden_dims*4
 
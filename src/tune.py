@@ -210,7 +210,7 @@ class RayTrainer(ray.tune.Trainable):
         self.traindataloader, self.validdataloader = prepare_dataset(args)
 
         args.nclasses = self.traindataloader.dataset.nclasses
-        args.seqlength = self.traindataloader.dataset.sequencelength
+        args.seqlength = max(self.traindataloader.dataset.sequencelength, self.validdataloader.dataset.sequencelength)
         args.input_dims = self.traindataloader.dataset.ndims
 
         self.model = getModel(args)
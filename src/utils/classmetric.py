@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 def confusion_matrix_to_accuraccies(confusion_matrix):
 
@@ -25,43 +26,108 @@ def confusion_matrix_to_accuraccies(confusion_matrix):
     return overall_accuracy, kappa, precision, recall, f1, cl_acc
 
 class ClassMetric(object):
+    """
+    Confusion matrix and running means of batch statistics (e.g. the loss) of an epoch.
+    add(), update_confmat() and update_earliness() only accumulate sums and counts per batch. The means and the
+    metrics of the confusion matrix are derived when they are requested with mean(), accuracy() or stats().
+
+    Tensors are accumulated on their device (e.g. the GPU of the model) and copied to the host when the
+    metrics are requested, so batches need no synchronization with the host
+    """
     def __init__(self, num_classes=2, ignore_index=0):
         self.num_classes = num_classes
         _range = -0.5, num_classes - 0.5
         self.range = np.array((_range, _range), dtype=np.int64)
         self.ignore_index = ignore_index
-        self.hist = np.zeros((num_classes, num_classes), dtype=np.float64)
+        self._hist = np.zeros((num_classes, num_classes), dtype=np.float64)
+        self.device_hist = None
 
-        self.store = dict()
+        # running sums, number of values and dtype of each batch statistic
+        self.sums = dict()
+        self.counts = dict()
+        self.dtypes = dict()
 
-        self.earliness_record = list()
+        self.earliness_sum = 0.
+        self.earliness_count = 0
 
     def _update(self, o, t):
         t = t.flatten()
         o = o.flatten()
         # confusion matrix
         n, _, _ = np.histogram2d(t, o, bins=self.num_classes, range=self.range)
-        self.hist += n
+        self._hist += n
+
+    def _update_tensor(self, o, t):
+        """confusion matrix counts of tensors of class ids, accumulated on their device"""
+        t = t.flatten().long()
+        o = o.flatten().long()
+        # index of each (target, prediction) pair. Pairs outside of the classes are ignored like by np.histogram2d
+        n = self.num_classes
+        valid = (t >= 0) & (t < n) & (o >= 0) & (o < n)
+        index = torch.where(valid, t * n + o, torch.full_like(t, n * n))
+
+        if self.device_hist is None:
+            self.device_hist = torch.zeros(n * n + 1, dtype=torch.long, device=t.device)
+        # scatter_add_ instead of torch.bincount, which reads the maximum index back to the host on cuda
+        self.device_hist.scatter_add_(0, index, torch.ones_like(index))
+
+    @property
+    def hist(self):
+        """confusion matrix [n_classes x n_classes], rows true classes. Copies the counts of a device to the host"""
+        if self.device_hist is not None:
+            self._hist += self.device_hist[:-1].view(self.num_classes, self.num_classes).cpu().numpy()
+            self.device_hist = None
+        return self._hist
 
     def add(self, stats):
+        """adds the values of stats (tensors, e.g. dict(loss=loss)) to the running sums of mean()"""
         for key, value in stats.items():
 
-            value = value.data.cpu().numpy()
+            value = value.detach()
 
-            if key in self.store.keys():
-                self.store[key].append(value)
-            else:
-                self.store[key] = list([value])
+            self.sums[key] = self.sums.get(key, 0.) + value.double().sum()
+            self.counts[key] = self.counts.get(key, 0) + value.numel()
+            self.dtypes[key] = value.dtype
 
-        return dict((k, np.stack(v).mean()) for k, v in self.store.items())
+    def mean(self):
+        """mean of all values added to each statistic"""
+        means = dict()
+        for key in self.sums.keys():
+            # numpy scalar of the dtype of the added tensors, e.g. np.float32 for the loss
+            dtype = torch.zeros(0, dtype=self.dtypes[key]).numpy().dtype
+            means[key] = dtype.type(float(self.sums[key]) / self.counts[key])
+        return means
 
     def update_confmat(self, target, output):
-        self._update(output, target)
-        return self.accuracy()
+        """adds target and predicted class ids (numpy arrays or tensors) to the confusion matrix"""
+        if isinstance(target, torch.Tensor):
+            self._update_tensor(output, target)
+        else:
+            self._update(output, target)
 
     def update_earliness(self,earliness):
-        self.earliness_record.append(earliness)
-        return np.hstack(self.earliness_record).mean()
+        earliness = np.asarray(earliness)
+        self.earliness_sum += earliness.sum(dtype=np.float64)
+        self.earliness_count += earliness.size
+
+    def earliness(self):
+        return self.earliness_sum / self.earliness_count
+
+    def stats(self):
+        """means of the batch statistics followed by the summary metrics of the confusion matrix, as logged per epoch"""
+        stats = self.mean()
+
+        accuracy_metrics = self.accuracy()
+        stats["accuracy"] = accuracy_metrics["overall_accuracy"]
+        stats["mean_accuracy"] = accuracy_metrics["accuracy"].mean()
+        stats["mean_recall"] = accuracy_metrics["recall"].mean()
+        stats["mean_precision"] = accuracy_metrics["precision"].mean()
+        stats["mean_f1"] = accuracy_metrics["f1"].mean()
+        stats["kappa"] = accuracy_metrics["kappa"]
+        if self.earliness_count > 0:
+            stats["earliness"] = self.earliness()
+
+        return stats
 
     def accuracy(self):
         """
@@ -41,6 +41,12 @@ class Logger():
 
         self.log_numbers(clean_stats, epoch)
 
+    def log_arrays(self, stats, epoch):
+        """logs only the arrays of stats, e.g. the outputs of an epoch whose numbers are logged already"""
+        for k,v in stats.items():
+            if np.array(v).size != 1:
+                self.log_array(name=k,array=v, epoch=epoch)
+
     def log_array(self, name, array, epoch):
 
         if name not in self.stored_arrays.keys():
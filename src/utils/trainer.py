@@ -20,6 +20,24 @@ import copy
 CLASSIFICATION_PHASE_NAME="classification"
 EARLINESS_PHASE_NAME="earliness"
 
+def get_rng_state():
+    """
+    state of the numpy, torch and cuda generators that draw sampled times and sample orders (ResidentLoader draws
+    on the device)
+    """
+    cuda = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    return np.random.get_state(), torch.random.get_rng_state(), cuda
+
+def set_rng_state(state):
+    np.random.set_state(state[0])
+    torch.random.set_rng_state(state[1])
+    if state[2] is not None:
+        torch.cuda.set_rng_state_all(state[2])
+
+def cpu_state_dict(model):
+    """copy of the weights of model in host memory"""
+    return dict((k, v.detach().cpu().clone()) for k, v in model.state_dict().items())
+
 class Trainer():
 
     def __init__(self,
@@ -36,6 +54,7 @@ class Trainer():
                  show_n_samples=1,
                  overwrite=True,
                  logger=None,
+                 lightweight_test=False,
                  **kwargs):
 
         self.epochs = epochs
@@ -52,6 +71,13 @@ class Trainer():
         self.early_stopping_smooth_period = 10
         self.early_stopping_patience = 5
         self.not_improved_epochs=0
+        # test epochs only stream loss and confusion matrix. see log_test_details
+        self.lightweight_test = lightweight_test
+        self.best_kappa = None
+        self.best_epoch = None
+        self.best_state = None
+        self.last_test_epoch = None
+        self.last_state = None
         #self.early_stopping_metric="kappa"
 
         if optimizer is None:
@@ -109,8 +135,16 @@ class Trainer():
 
             if self.epoch % self.test_every_n_epochs == 0 or self.epoch==1:
                 self.logger.set_mode("test")
-                stats = self.test_epoch(self.validdataloader)
+                if self.lightweight_test:
+                    # weights and random state (time sampling, order) to repeat this test epoch in log_test_details
+                    self.last_state = (cpu_state_dict(self.model), get_rng_state())
+                stats = self.test_epoch(self.validdataloader, details=not self.lightweight_test)
                 self.logger.log(stats, self.epoch)
+                self.last_test_epoch = self.epoch
+                if self.lightweight_test and (self.best_kappa is None or stats["kappa"] > self.best_kappa):
+                    self.best_kappa = stats["kappa"]
+                    self.best_epoch = self.epoch
+                    self.best_state = self.last_state
                 printer.print(stats, self.epoch, prefix="\n"+self.validdataloader.dataset.partition+": ")
                 if self.visdom is not None:
                     self.visdom_log_test_run(stats)
@@ -131,10 +165,40 @@ class Trainer():
                 self.snapshot(self.get_model_name())
                 print("Saving log to {}".format(self.get_log_name()))
                 self.logger.get_data().to_csv(self.get_log_name())
-                return self.logger
+                break
+
+        if self.lightweight_test:
+            self.log_test_details()
 
         return self.logger
 
+    def log_test_details(self):
+        """
+        logs the per-sample outputs (predictions, labels, probas, ids, ...) that lightweight test epochs skip for the
+        last test epoch and for the test epoch with the best kappa. These outputs come from a re-evaluation with the
+        weights and the random state (numpy and torch) stored at the start of that test epoch, so sampled times and
+        sample order repeat the logged epoch if the test data loader only draws from these generators
+        """
+        if self.last_test_epoch is None:
+            return
+        self.logger.set_mode("test")
+
+        epochs = [(self.last_test_epoch, self.last_state)]
+        if self.best_epoch is not None and self.best_epoch != self.last_test_epoch:
+            epochs.append((self.best_epoch, self.best_state))
+
+        model_state, rng_state = cpu_state_dict(self.model), get_rng_state()
+        for epoch, (state, rng) in epochs:
+            self.model.load_state_dict(state)
+            set_rng_state(rng)
+            print("logging test outputs of epoch {}".format(epoch))
+            stats = self.test_epoch(self.validdataloader)
+            # numbers and confusion matrix of the epoch have been logged already
+            stats.pop("confusion_matrix")
+            self.logger.log_arrays(stats, epoch)
+        self.model.load_state_dict(model_state)
+        set_rng_state(rng_state)
+
     def check_for_early_stopping(self,smooth_period):
         log = self.logger.get_data()
         log = log.loc[log["mode"] == "test"]
@@ -168,6 +232,9 @@ class Trainer():
         self.visdom.confusion_matrix(stats["confusion_matrix"], norm=None, title="Confusion Matrix", logscale=None)
         self.visdom.confusion_matrix(stats["confusion_matrix"], norm=0, title="Recall")
         self.visdom.confusion_matrix(stats["confusion_matrix"], norm=1, title="Precision")
+        if "targets" not in stats.keys():
+            # lightweight test epoch without samples
+            return
         legend = ["class {}".format(c) for c in range(self.nclasses)]
         targets = stats["targets"]
         # either user-specified value or all available values
@@ -191,6 +258,12 @@ class Trainer():
     def get_log_name(self):
         return os.path.join(self.store, "log.csv")
 
+    def forward(self, inputs, lengths=None):
+        """model outputs of inputs [B x T x D]. The lengths [B] of padded batches are passed to models that accept them"""
+        if lengths is not None and getattr(self.model, "accepts_lengths", False):
+            return self.model.forward(inputs.transpose(1, 2), lengths=lengths)
+        return self.model.forward(inputs.transpose(1, 2))
+
     def train_epoch(self, epoch):
         # sets the model to train mode: dropout is applied
         self.model.train()
@@ -201,13 +274,15 @@ class Trainer():
         for iteration, data in enumerate(self.traindataloader):
             self.optimizer.zero_grad()
 
-            inputs, targets, _ = data
+            # batches of pad_collate carry lengths and mask after inputs, targets and ids
+            inputs, targets, _ = data[:3]
+            lengths = data[3] if len(data) > 3 else None
 
             if torch.cuda.is_available():
                 inputs = inputs.cuda()
                 targets = targets.cuda()
 
-            logprobabilities, deltas, pts, budget = self.model.forward(inputs.transpose(1,2))
+            logprobabilities, deltas, pts, budget = self.forward(inputs, lengths)
 
             loss = F.nll_loss(logprobabilities, targets[:, 0])
 
@@ -224,22 +299,23 @@ class Trainer():
             prediction = self.model.predict(logprobabilities)
             t_stop = None
 
-            stats = metric.add(stats)
+            metric.add(stats)
 
-            accuracy_metrics = metric.update_confmat(targets.mode(1)[0].detach().cpu().numpy(), prediction.detach().cpu().numpy())
-            stats["accuracy"] = accuracy_metrics["overall_accuracy"]
-            stats["mean_accuracy"] = accuracy_metrics["accuracy"].mean()
-            stats["mean_recall"] = accuracy_metrics["recall"].mean()
-            stats["mean_precision"] = accuracy_metrics["precision"].mean()
-            stats["mean_f1"] = accuracy_metrics["f1"].mean()
-            stats["kappa"] = accuracy_metrics["kappa"]
+            # accumulated on the device of the model without copying the batch to the host
+            metric.update_confmat(targets.mode(1)[0].detach(), prediction.detach())
             if t_stop is not None:
                 earliness = (t_stop.float()/(inputs.shape[1]-1)).mean()
-                stats["earliness"] = metric.update_earliness(earliness.cpu().detach().numpy())
+                metric.update_earliness(earliness.cpu().detach().numpy())
 
-        return stats
+        # metrics are derived once from the accumulated confusion matrix and means
+        return metric.stats()
 
-    def test_epoch(self, dataloader, epoch=None):
+    def test_epoch(self, dataloader, epoch=None, details=True):
+        """
+        loss and accuracy metrics of the model on dataloader with the confusion matrix. With details=True also the
+        predictions, labels, class probabilities and ids of all samples and the inputs and targets of the last batch.
+        details=False only streams the loss and the confusion matrix counts
+        """
         # sets the model to train mode: no dropout is applied
         self.model.eval()
 
@@ -258,13 +334,14 @@ class Trainer():
         with torch.no_grad():
             for iteration, data in enumerate(dataloader):
 
-                inputs, targets, ids = data
+                inputs, targets, ids = data[:3]
+                lengths = data[3] if len(data) > 3 else None
 
                 if torch.cuda.is_available():
                     inputs = inputs.cuda()
                     targets = targets.cuda()
 
-                logprobabilities, deltas, pts, budget = self.model.forward(inputs.transpose(1, 2))
+                logprobabilities, deltas, pts, budget = self.forward(inputs, lengths)
 
                 loss = F.nll_loss(logprobabilities, targets[:, 0])
 
@@ -275,9 +352,16 @@ class Trainer():
                 prediction = self.model.predict(logprobabilities)
                 t_stop = None
 
+                label = targets.mode(1)[0].detach()
+                metric.update_confmat(label, prediction.detach())
+
+                if not details:
+                    metric.add(stats)
+                    continue
+
                 ## enter numpy world
                 prediction = prediction.detach().cpu().numpy()
-                label = targets.mode(1)[0].detach().cpu().numpy()
+                label = label.cpu().numpy()
                 if t_stop is not None: t_stop = t_stop.cpu().detach().numpy()
                 if pts is not None: pts = pts.detach().cpu().numpy()
                 if deltas is not None: deltas = deltas.detach().cpu().numpy()
@@ -289,27 +373,22 @@ class Trainer():
                 probas.append(logprobabilities.exp().detach().cpu().numpy())
                 ids_list.append(ids.detach().cpu().numpy())
 
-                stats = metric.add(stats)
+                metric.add(stats)
 
-                accuracy_metrics = metric.update_confmat(label,
-                                                         prediction)
-
-                stats["accuracy"] = accuracy_metrics["overall_accuracy"]
-                stats["mean_accuracy"] = accuracy_metrics["accuracy"].mean()
-
-                #for cl in range(len(accuracy_metrics["accuracy"])):
-                #    acc = accuracy_metrics["accuracy"][cl]
-                #    stats["class_{}_accuracy".format(cl)] = acc
-
-                stats["mean_recall"] = accuracy_metrics["recall"].mean()
-                stats["mean_precision"] = accuracy_metrics["precision"].mean()
-                stats["mean_f1"] = accuracy_metrics["f1"].mean()
-                stats["kappa"] = accuracy_metrics["kappa"]
                 if t_stop is not None:
                     earliness = (t_stop.astype(float) / (inputs.shape[1] - 1)).mean()
-                    stats["earliness"] = metric.update_earliness(earliness)
+                    metric.update_earliness(earliness)
+
+            stats = metric.stats()
+
+            #for cl in range(len(accuracy_metrics["accuracy"])):
+            #    acc = accuracy_metrics["accuracy"][cl]
+            #    stats["class_{}_accuracy".format(cl)] = acc
 
             stats["confusion_matrix"] = copy.copy(metric.hist)
+            if not details:
+                return stats
+
             stats["targets"] = targets.cpu().numpy()
             stats["inputs"] = inputs.cpu().numpy()
             if deltas is not None: stats["deltas"] = deltas